@@ -1,13 +1,30 @@
 # backend/app.py
 
 import os
+import json
+import time
+import atexit
+import sqlite3
+import tempfile
+import uuid
+import hashlib
+import hmac
+import base64
+import bisect
+from collections import OrderedDict, defaultdict, deque
 from datetime import datetime, timezone
-from flask import Flask, jsonify, request, make_response, g
+from flask import Flask, jsonify, request, make_response, g, Response, stream_with_context, has_request_context
 from dotenv import load_dotenv
 import jwt
+import click
 from flask_cors import CORS
 import requests
+import httpx
+import threading
 from functools import wraps
+from contextlib import contextmanager
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
 from supabase import create_client, Client
 
 load_dotenv()
@@ -24,25 +41,1401 @@ CORS(app,
 # Si no está definida, usamos un valor por defecto para desarrollo.
 N8N_BASE_URL = os.getenv('N8N_INTERNAL_URL', 'http://n8n:5678/')
 
+def env_map(name, cast=str):
+    # Variables con formato "clave=valor,clave=valor", p. ej. "analyze-alignment=1,validar-di=3".
+    return {
+        key.strip(): cast(value.strip())
+        for key, value in (item.split('=', 1) for item in os.getenv(name, '').split(',') if '=' in item)
+    }
+
+# --- MÉTRICAS INTERNAS ---
+# Contadores simples por worker. Cada componente puede registrar además una
+# función que aporte su propio estado (tamaño de caches, colas, etc.).
+_metrics_lock = threading.Lock()
+_counters = defaultdict(int)
+_stats_providers = {}
+
+def metric_inc(name, amount=1):
+    with _metrics_lock:
+        _counters[name] += amount
+
+def register_stats(name):
+    def decorator(f):
+        _stats_providers[name] = f
+        return f
+    return decorator
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else None
+
+class TTLCache:
+    """LRU acotado con expiración por entrada, seguro entre hilos."""
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                value = entry[1]
+            else:
+                if entry is not None:
+                    del self._data[key]
+                value = None
+        metric_inc(f"{self.name}_hits" if value is not None else f"{self.name}_misses")
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                metric_inc(f"{self.name}_evictions")
+
+    def pop(self, key):
+        with self._lock:
+            return self._data.pop(key, (None, None))[1]
+
+    def __len__(self):
+        return len(self._data)
+
+# --- MÉTRICAS PROMETHEUS (/metrics) ---
+# Histogramas de latencia por ruta y por dependencia (jwt, supabase, storage,
+# broadcast, n8n), gauges de peticiones en curso y errores por dependencia.
+# Cada worker acumula en memoria y vuelca su estado cada METRICS_FLUSH_INTERVAL
+# a un archivo propio en METRICS_DIR; /metrics suma los archivos de todos los
+# workers (los gauges sólo de los procesos vivos) y responde en formato texto.
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'validador_qm_metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRICS_HELP = {
+    'http_request_duration_seconds': 'Latencia de las rutas de la API.',
+    'http_requests_in_flight': 'Peticiones HTTP en curso.',
+    'dependency_request_duration_seconds': 'Latencia de las llamadas a dependencias externas.',
+    'dependency_requests_in_flight': 'Llamadas a dependencias en curso.',
+    'dependency_errors_total': 'Errores por dependencia y tipo.',
+    'backend_events_total': 'Contadores internos del backend (ver /api/admin/stats).',
+    'outbox_lane_wait_seconds': 'Espera en cola de los trabajos del outbox hasta que un worker los toma, por carril.',
+}
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._data_pid = os.getpid()
+        self._reset()
+
+    def _reset(self):
+        self._histograms = {}
+        self._counters = defaultdict(float)
+        self._gauges = defaultdict(float)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._data_pid != os.getpid():
+                self._reset()  # lo heredado del proceso padre no es de este worker
+                self._data_pid = os.getpid()
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='metrics-flusher', daemon=True).start()
+
+    def observe(self, name, labels, value):
+        index = bisect.bisect_left(HISTOGRAM_BUCKETS, value)
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = [[0] * (len(HISTOGRAM_BUCKETS) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += value
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self._counters[(name, labels)] += amount
+
+    def gauge_add(self, name, labels, amount):
+        with self._lock:
+            self._gauges[(name, labels)] += amount
+
+    def dump(self):
+        with self._lock:
+            histograms = [[name, labels, counts[:], total] for (name, labels), (counts, total) in self._histograms.items()]
+            counters = [[name, labels, value] for (name, labels), value in self._counters.items()]
+            gauges = [[name, labels, value] for (name, labels), value in self._gauges.items()]
+        with _metrics_lock:
+            counters += [['backend_events_total', (('name', event),), value] for event, value in _counters.items()]
+        return {'pid': os.getpid(), 'histograms': histograms, 'counters': counters, 'gauges': gauges}
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f'metrics-{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.dump(), f)
+        os.replace(path + '.tmp', path)
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.error(f"No se pudieron volcar las métricas: {str(e)}")
+
+_metrics = MetricsRegistry()
+atexit.register(_metrics.flush)
+
+@contextmanager
+def observe_dependency(dependency, operation=''):
+    _metrics.gauge_add('dependency_requests_in_flight', (('dependency', dependency),), 1)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        dependency_error(dependency, type(e).__name__)
+        raise
+    finally:
+        _metrics.gauge_add('dependency_requests_in_flight', (('dependency', dependency),), -1)
+        _metrics.observe('dependency_request_duration_seconds', (('dependency', dependency), ('operation', operation)),
+                         time.perf_counter() - started)
+
+def dependency_error(dependency, kind):
+    _metrics.inc('dependency_errors_total', (('dependency', dependency), ('kind', kind)))
+
+class TimedTransport(httpx.BaseTransport):
+    # Envuelve el transporte httpx de los clientes de Supabase: mide cada
+    # petición (hasta recibir las cabeceras) y cuenta los 5xx como errores.
+    def __init__(self, transport, dependency, operation):
+        self._transport = transport
+        self.dependency = dependency
+        self.operation = operation
+
+    def handle_request(self, request):
+        with observe_dependency(self.dependency, self.operation(request)):
+            response = self._transport.handle_request(request)
+        if response.status_code >= 500:
+            dependency_error(self.dependency, f'http_{response.status_code}')
+        return response
+
+    def close(self):
+        self._transport.close()
+
+def instrument_httpx(client, dependency, operation):
+    client._transport = TimedTransport(client._transport, dependency, operation)
+
+def observed_post(post, dependency, operation, url, **kwargs):
+    with observe_dependency(dependency, operation):
+        response = post(url, **kwargs)
+    if response.status_code >= 500:
+        dependency_error(dependency, f'http_{response.status_code}')
+    return response
+
+def _merge_metric_files():
+    histograms, counters, gauges = {}, defaultdict(float), defaultdict(float)
+    for filename in os.listdir(METRICS_DIR):
+        if not (filename.startswith('metrics-') and filename.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, labels, counts, total in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [[0] * len(counts), 0.0])
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+        for name, labels, value in snapshot['counters']:
+            counters[(name, tuple(map(tuple, labels)))] += value
+        if _pid_alive(snapshot['pid']):
+            for name, labels, value in snapshot['gauges']:
+                gauges[(name, tuple(map(tuple, labels)))] += value
+    return histograms, counters, gauges
+
+def histogram_quantile(counts, q):
+    total = sum(counts)
+    if not total:
+        return None
+    cumulative = 0
+    for bound, count in zip([*HISTOGRAM_BUCKETS, '+Inf'], counts):
+        cumulative += count
+        if cumulative >= q * total:
+            return bound
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _label_text(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+def render_metrics():
+    histograms, counters, gauges = _merge_metric_files()
+    by_name, kinds = defaultdict(list), {}
+    for kind, series in (('histogram', histograms), ('counter', counters), ('gauge', gauges)):
+        for (name, labels), value in series.items():
+            by_name[name].append((labels, value))
+            kinds[name] = kind
+    lines = []
+    for name in sorted(by_name):
+        kind = kinds[name]
+        lines += [f'# HELP {name} {METRICS_HELP.get(name, name)}', f'# TYPE {name} {kind}']
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_label_text(labels)} {value:g}')
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip([*HISTOGRAM_BUCKETS, '+Inf'], counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_label_text(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_label_text(labels)} {total:.6f}')
+            lines.append(f'{name}_count{_label_text(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+@app.before_request
+def _metrics_before_request():
+    _metrics._ensure_started()
+    g.metrics_started = time.perf_counter()
+    _metrics.gauge_add('http_requests_in_flight', (), 1)
+
+@app.after_request
+def _metrics_after_request(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def _metrics_teardown_request(exc):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    _metrics.gauge_add('http_requests_in_flight', (), -1)
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    status = g.pop('metrics_status', 500)
+    _metrics.observe('http_request_duration_seconds', (('method', request.method), ('route', route), ('status', f'{status // 100}xx')),
+                     time.perf_counter() - started)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'message': 'No autorizado.'}), 401
+    _metrics.flush()
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# --- TRAZAS DE EXTREMO A EXTREMO ---
+# Cada petición recibe un trace id (o adopta el de `traceparent` / X-Trace-Id)
+# que se devuelve en X-Trace-Id, viaja en cada payload de n8n y en cada
+# broadcast, y se hereda en los trabajos del outbox y en los trabajos de IA.
+# El gateway registra sus tramos (petición, encolado, espera en cola, llamada
+# a n8n) y n8n puede reportar los suyos (agentes de Gemini, escritura en
+# Supabase) a POST /api/traces/spans. Los tramos se guardan en la base local
+# y se exportan como cascada JSON u OTLP/JSON.
+TRACE_CALLBACK_URL = os.getenv('TRACE_CALLBACK_URL', 'http://backend:5000/api/traces/spans')
+TRACE_CALLBACK_TOKEN = os.getenv('TRACE_CALLBACK_TOKEN')
+TRACE_RETENTION_SECONDS = float(os.getenv('TRACE_RETENTION_SECONDS', str(7 * 86400)))
+TRACE_SERVICE = 'validador-qm-backend'
+_trace_local = threading.local()
+
+def new_span_id():
+    return uuid.uuid4().hex[:16]
+
+def incoming_trace_id():
+    traceparent = request.headers.get('traceparent', '').split('-')
+    candidate = traceparent[1] if len(traceparent) == 4 else request.headers.get('X-Trace-Id', '')
+    return candidate.lower() if len(candidate) == 32 and all(c in '0123456789abcdefABCDEF' for c in candidate) else None
+
+def current_trace():
+    if has_request_context() and 'trace_id' in g:
+        return g.trace_id, g.trace_span_id
+    return getattr(_trace_local, 'trace_id', None), getattr(_trace_local, 'span_id', None)
+
+def _set_current_span(span_id):
+    if has_request_context() and 'trace_id' in g:
+        g.trace_span_id = span_id
+    else:
+        _trace_local.span_id = span_id
+
+@contextmanager
+def trace_context(trace_id, parent_span_id=None):
+    # Hilos de fondo (outbox, trabajos de IA): adoptan la traza de quien encoló.
+    previous = (getattr(_trace_local, 'trace_id', None), getattr(_trace_local, 'span_id', None))
+    _trace_local.trace_id, _trace_local.span_id = trace_id or uuid.uuid4().hex, parent_span_id
+    try:
+        yield
+    finally:
+        _trace_local.trace_id, _trace_local.span_id = previous
+
+def record_span(trace_id, span_id, parent_id, name, start, end, di_id=None, service=TRACE_SERVICE, attributes=None):
+    row = (trace_id, span_id, parent_id, name, service, str(di_id) if di_id else None, start, end, json.dumps(attributes or {}))
+    if has_request_context() and 'trace_spans' in g:
+        g.trace_spans.append(row)  # se escriben juntos al cerrar la petición
+    else:
+        _write_spans([row])
+
+def _write_spans(rows):
+    try:
+        state_db().executemany(
+            'INSERT OR REPLACE INTO trace_spans (trace_id, span_id, parent_id, name, service, di_id, start_time, end_time, attributes)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    except Exception as e:
+        app.logger.warning(f"No se pudieron guardar {len(rows)} tramo(s) de traza: {str(e)}")
+
+@contextmanager
+def trace_span(name, di_id=None, **attributes):
+    trace_id, parent_id = current_trace()
+    if trace_id is None:
+        yield None
+        return
+    span_id, started = new_span_id(), time.time()
+    _set_current_span(span_id)
+    try:
+        yield span_id
+    except Exception as e:
+        attributes['error'] = type(e).__name__
+        raise
+    finally:
+        _set_current_span(parent_id)
+        record_span(trace_id, span_id, parent_id, name, started, time.time(), di_id=di_id, attributes=attributes)
+
+def with_trace(payload):
+    trace_id, span_id = current_trace()
+    if trace_id is None or not isinstance(payload, dict):
+        return payload
+    return {**payload, 'trace': {'trace_id': trace_id, 'parent_span_id': span_id, 'callback_url': TRACE_CALLBACK_URL}}
+
+@app.before_request
+def _trace_before_request():
+    g.trace_id, g.trace_span_id = incoming_trace_id() or uuid.uuid4().hex, new_span_id()
+    g.trace_root_span_id, g.trace_started, g.trace_spans = g.trace_span_id, time.time(), []
+
+@app.after_request
+def _trace_after_request(response):
+    if 'trace_id' in g:
+        response.headers['X-Trace-Id'] = g.trace_id
+    return response
+
+@app.teardown_request
+def _trace_teardown_request(exc):
+    spans = g.pop('trace_spans', None)
+    if not spans:
+        return  # sólo se guardan las peticiones que despacharon trabajo
+    route = request.url_rule.rule if request.url_rule else request.path
+    spans.append((g.trace_id, g.trace_root_span_id, None, f"{request.method} {route}", TRACE_SERVICE,
+                  (request.view_args or {}).get('di_id') and str(request.view_args['di_id']), g.trace_started, time.time(),
+                  json.dumps({'user_id': g.get('user_id'), 'error': type(exc).__name__ if exc else None})))
+    _write_spans(spans)
+
+def span_time(value):
+    if isinstance(value, (int, float)):
+        return value / 1000 if value > 1e11 else float(value)  # epoch en ms o en s
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+
+def trace_rows(trace_id):
+    return [dict(row) for row in state_db().execute('SELECT * FROM trace_spans WHERE trace_id = ? ORDER BY start_time', (trace_id,))]
+
+def trace_waterfall(trace_id):
+    rows = trace_rows(trace_id)
+    if not rows:
+        return None
+    origin = rows[0]['start_time']
+    parents = {row['span_id']: row['parent_id'] for row in rows}
+
+    def depth(span_id):
+        level, seen = 0, set()
+        while parents.get(span_id) in parents and span_id not in seen:
+            seen.add(span_id)
+            span_id, level = parents[span_id], level + 1
+        return level
+
+    return {
+        'trace_id': trace_id,
+        'started_at': datetime.fromtimestamp(origin, timezone.utc).isoformat(),
+        'duration_ms': round((max(row['end_time'] for row in rows) - origin) * 1000, 1),
+        'spans': [{'span_id': row['span_id'], 'parent_id': row['parent_id'], 'name': row['name'], 'service': row['service'],
+                   'di_id': row['di_id'], 'depth': depth(row['span_id']), 'offset_ms': round((row['start_time'] - origin) * 1000, 1),
+                   'duration_ms': round((row['end_time'] - row['start_time']) * 1000, 1), 'attributes': json.loads(row['attributes'] or '{}')}
+                  for row in rows],
+    }
+
+def trace_otlp(trace_id):
+    by_service = defaultdict(list)
+    for row in trace_rows(trace_id):
+        attributes = {**json.loads(row['attributes'] or '{}'), **({'di_id': row['di_id']} if row['di_id'] else {})}
+        by_service[row['service']].append({
+            'traceId': row['trace_id'], 'spanId': row['span_id'], 'parentSpanId': row['parent_id'] or '', 'name': row['name'], 'kind': 1,
+            'startTimeUnixNano': str(int(row['start_time'] * 1e9)), 'endTimeUnixNano': str(int(row['end_time'] * 1e9)),
+            'attributes': [{'key': key, 'value': {'stringValue': str(value)}} for key, value in attributes.items() if value is not None],
+        })
+    return {'resourceSpans': [
+        {'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}}]},
+         'scopeSpans': [{'scope': {'name': 'validador-qm'}, 'spans': spans}]}
+        for service, spans in by_service.items()]}
+
+@app.cli.command('export-trace')
+@click.argument('trace_id')
+@click.option('--out', default='.', help='Directorio de destino.')
+def export_trace_command(trace_id, out):
+    """Exporta una traza como <trace_id>.json (cascada) y <trace_id>.otlp.json."""
+    waterfall = trace_waterfall(trace_id)
+    if waterfall is None:
+        raise click.ClickException(f'No hay tramos para la traza {trace_id}.')
+    os.makedirs(out, exist_ok=True)
+    for suffix, data in (('json', waterfall), ('otlp.json', trace_otlp(trace_id))):
+        path = os.path.join(out, f'{trace_id}.{suffix}')
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        click.echo(path)
+
+# --- DIFUSIÓN DE CAMBIOS (REALTIME) ---
+# Los eventos se encolan y un hilo en segundo plano los envía agrupados en un
+# solo arreglo `messages` por ventana, reutilizando una sesión keep-alive. Los
+# UPDATE sucesivos de un mismo DI se fusionan: sólo viaja el estado más reciente.
+BROADCAST_BATCH_WINDOW = float(os.getenv('BROADCAST_BATCH_WINDOW', '0.2'))
+BROADCAST_MAX_BATCH = int(os.getenv('BROADCAST_MAX_BATCH', '100'))
+
+class BroadcastDispatcher:
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        # Tras un fork el hilo no existe en el hijo: se crea uno por proceso.
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._cond = threading.Condition()
+            self._pending = OrderedDict()
+            self._seq = 0
+            self._session = requests.Session()
+            threading.Thread(target=self._run, name='broadcast-dispatcher', daemon=True).start()
+            self._pid = os.getpid()
+
+    def publish(self, message):
+        self._ensure_started()
+        new_data = message['payload']['new'] or {}
+        with self._cond:
+            if message['payload']['eventType'] == 'UPDATE' and new_data.get('id_di'):
+                key = ('UPDATE', str(new_data['id_di']))
+                if self._pending.pop(key, None) is not None:
+                    metric_inc('broadcast_coalesced')
+            else:
+                self._seq += 1
+                key = ('seq', self._seq)
+            self._pending[key] = message
+            self._cond.notify()
+
+    def pending(self):
+        return len(self._pending) if self._pid == os.getpid() else 0
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+        # Damos margen a que lleguen más eventos de la misma ventana.
+        time.sleep(self.window)
+        with self._cond:
+            batch = []
+            while self._pending and len(batch) < self.max_batch:
+                batch.append(self._pending.popitem(last=False)[1])
+            return batch
+
+    def _run(self):
+        while True:
+            self._send(self._take_batch())
+
+    def _send(self, batch):
+        try:
+            broadcast_url = f"{os.getenv('SUPABASE_URL')}/realtime/v1/api/broadcast"
+            headers = {"apikey": os.getenv("SUPABASE_SERVICE_KEY"), "Content-Type": "application/json"}
+            with observe_dependency('broadcast', 'send'):
+                self._session.post(broadcast_url, json={"messages": batch}, headers=headers, timeout=3)
+            metric_inc('broadcast_batches')
+            metric_inc('broadcast_messages', len(batch))
+            app.logger.info(f"Broadcast enviado: {len(batch)} evento(s)")
+        except Exception as e:
+            metric_inc('broadcast_errors')
+            app.logger.error(f"Error al enviar broadcast: {str(e)}")
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            batch = list(self._pending.values())
+            self._pending.clear()
+        for i in range(0, len(batch), self.max_batch):
+            self._send(batch[i:i + self.max_batch])
+
+_broadcaster = BroadcastDispatcher(BROADCAST_BATCH_WINDOW, BROADCAST_MAX_BATCH)
+atexit.register(_broadcaster.flush)
+
+@register_stats('broadcast')
+def _broadcast_stats():
+    return {'pending': _broadcaster.pending()}
+
 def broadcast_change(event_type, new_data=None, old_data=None):
+    sync_di_meta(event_type, new_data, old_data)
+    if not os.getenv("SUPABASE_URL") or not os.getenv("SUPABASE_SERVICE_KEY"):
+        app.logger.error("Broadcast fallido: Credenciales de Supabase no configuradas.")
+        return
+    _broadcaster.publish({"topic": "di_changes", "event": "di_update", "payload": {
+        "eventType": event_type, "new": new_data, "old": old_data, "trace_id": current_trace()[0]
+    }})
+
+# --- ESTADO LOCAL DURABLE (SQLITE) ---
+# Base SQLite compartida por todos los workers del contenedor. Cada hilo abre
+# su propia conexión; WAL permite lecturas concurrentes mientras otro escribe.
+STATE_DB_PATH = os.getenv('BACKEND_STATE_DB', os.path.join(tempfile.gettempdir(), 'validador_qm_state.sqlite3'))
+_state_local = threading.local()
+
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    webhook TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    di_id TEXT,
+    proceso TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    lease_until REAL,
+    last_error TEXT,
+    dedupe_key TEXT,
+    concurrency_group TEXT,
+    execution_id TEXT,
+    lane TEXT NOT NULL DEFAULT 'analysis',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS idx_outbox_di ON outbox (di_id, status);
+CREATE TABLE IF NOT EXISTS scheduler_leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    lease_until REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status TEXT NOT NULL,
+    http_status INTEGER,
+    content_type TEXT,
+    body BLOB,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys (expires_at);
+CREATE TABLE IF NOT EXISTS trace_spans (
+    trace_id TEXT NOT NULL,
+    span_id TEXT NOT NULL,
+    parent_id TEXT,
+    name TEXT NOT NULL,
+    service TEXT NOT NULL,
+    di_id TEXT,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    attributes TEXT,
+    PRIMARY KEY (trace_id, span_id)
+);
+CREATE INDEX IF NOT EXISTS idx_trace_spans_di ON trace_spans (di_id, start_time);
+CREATE INDEX IF NOT EXISTS idx_trace_spans_end ON trace_spans (end_time);
+CREATE TABLE IF NOT EXISTS ai_jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    http_status INTEGER,
+    result TEXT,
+    owner_pid INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Columnas añadidas después de crear la tabla: (tabla, columna, tipo).
+STATE_DB_MIGRATIONS = [
+    ('outbox', 'dedupe_key', 'TEXT'),
+    ('outbox', 'concurrency_group', 'TEXT'),
+    ('outbox', 'execution_id', 'TEXT'),
+    ('outbox', 'lane', "TEXT NOT NULL DEFAULT 'analysis'"),
+    ('outbox', 'trace_id', 'TEXT'),
+    ('outbox', 'trace_parent', 'TEXT'),
+    ('ai_jobs', 'owner_pid', 'INTEGER'),
+]
+
+def _migrate_state_db(conn):
+    for table, column, column_type in STATE_DB_MIGRATIONS:
+        columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+        if column not in columns:
+            try:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+            except sqlite3.OperationalError:
+                pass  # otro worker la añadió primero
+
+def state_db():
+    conn = getattr(_state_local, 'conn', None)
+    if conn is None or _state_local.pid != os.getpid():
+        os.makedirs(os.path.dirname(STATE_DB_PATH) or '.', exist_ok=True)
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(STATE_DB_SCHEMA)
+        _migrate_state_db(conn)
+        _state_local.conn = conn
+        _state_local.pid = os.getpid()
+    return conn
+
+# --- BANDEJA DE SALIDA (OUTBOX) DE WEBHOOKS DE N8N ---
+# Las rutas ya no llaman a n8n en línea: encolan el trabajo en SQLite y un pool
+# acotado de hilos lo entrega con reintentos y backoff exponencial, respetando
+# un máximo de ejecuciones simultáneas por webhook (contado entre todos los
+# workers). Si un worker muere con un trabajo en vuelo, su lease expira y otro
+# lo retoma. Cuando se agotan los intentos, el DI pasa a 'error' en vez de
+# quedar en 'processing' para siempre.
+#
+# Los topes cuentan ejecuciones de n8n, no peticiones HTTP: varios flujos
+# responden al recibir la petición (o agotan el timeout de lectura) y siguen
+# corriendo. Un trabajo entregado con DI y proceso pasa a 'running' y conserva
+# su cupo hasta que el `proceso_actual` del DI deja 'processing' (lo revisa un
+# worker cada OUTBOX_RUNNING_POLL segundos, o al instante si el cambio lo
+# escribe este backend), hasta que se encola otro trabajo para ese DI o hasta
+# que vence el plazo del proceso en PROCESS_DEADLINES, cuando el reaper se
+# hace cargo. Los trabajos sin DI (sincronizaciones) liberan el cupo al entregarse.
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_BACKOFF_BASE = float(os.getenv('OUTBOX_BACKOFF_BASE', '2'))
+OUTBOX_BACKOFF_MAX = float(os.getenv('OUTBOX_BACKOFF_MAX', '120'))
+OUTBOX_LEASE_SECONDS = float(os.getenv('OUTBOX_LEASE_SECONDS', '60'))
+OUTBOX_RETENTION_SECONDS = float(os.getenv('OUTBOX_RETENTION_SECONDS', '86400'))
+OUTBOX_CONNECT_TIMEOUT = float(os.getenv('OUTBOX_CONNECT_TIMEOUT', '3'))
+OUTBOX_READ_TIMEOUT = float(os.getenv('OUTBOX_READ_TIMEOUT', '10'))
+OUTBOX_RUNNING_POLL = float(os.getenv('OUTBOX_RUNNING_POLL', '5'))
+OUTBOX_DEFAULT_CONCURRENCY = int(os.getenv('OUTBOX_DEFAULT_CONCURRENCY', '2'))
+OUTBOX_CONCURRENCY = env_map('OUTBOX_CONCURRENCY', int)
+# Límites por grupo de trabajos, además del límite por webhook. Los barridos
+# masivos (endpoints /batch) usan el grupo 'batch': como mucho
+# BATCH_TRIGGER_CONCURRENCY DIs del barrido corren a la vez en n8n.
+BATCH_TRIGGER_CONCURRENCY = int(os.getenv('BATCH_TRIGGER_CONCURRENCY', '2'))
+OUTBOX_GROUP_CONCURRENCY = {'batch': BATCH_TRIGGER_CONCURRENCY, **env_map('OUTBOX_GROUP_CONCURRENCY', int)}
+# Carriles de prioridad: el chat ('interactive') no debe esperar detrás de un
+# barrido de análisis ni de una sincronización de glosarios. Cada carril tiene
+# su tope de ejecuciones de n8n en curso ('in_flight' + 'running', entre todos
+# los workers) y una ventaja en segundos al ordenar la cola: un trabajo compite
+# como si llevara esa ventaja esperando, así que uno de un carril menor que ya
+# esperó más que la diferencia pasa primero y ningún carril se queda sin turno.
+# Un webhook sin límite propio en OUTBOX_CONCURRENCY puede usar todo el cupo
+# de su carril, y uno con límite propio nunca supera el del carril.
+OUTBOX_DEFAULT_LANE = 'analysis'
+OUTBOX_LANES = {'interaccion-ia': 'interactive', 'sincronizar-dominio': 'admin_sync', 'sincronizar-vocabulario': 'admin_sync',
+                **env_map('OUTBOX_LANES')}
+OUTBOX_LANE_CONCURRENCY = {'interactive': 4, 'analysis': 3, 'admin_sync': 1, **env_map('OUTBOX_LANE_CONCURRENCY', int)}
+OUTBOX_LANE_HEAD_START = {'interactive': 300.0, 'analysis': 0.0, 'admin_sync': 60.0, **env_map('OUTBOX_LANE_HEAD_START', float)}
+
+def lane_concurrency(lane):
+    return OUTBOX_LANE_CONCURRENCY.get(lane, OUTBOX_DEFAULT_CONCURRENCY)
+
+def webhook_concurrency(webhook):
+    lane_limit = lane_concurrency(OUTBOX_LANES.get(webhook, OUTBOX_DEFAULT_LANE))
+    return min(OUTBOX_CONCURRENCY.get(webhook, lane_limit), lane_limit)
+
+def n8n_webhook_url(webhook):
+    return f"{N8N_BASE_URL.rstrip('/')}/webhook/{webhook}"
+
+# --- CIRCUIT BREAKER Y TIMEOUTS ADAPTATIVOS POR WEBHOOK ---
+# Cada webhook lleva una ventana con sus últimas llamadas (latencia, éxito).
+# Con suficientes muestras el timeout de las llamadas síncronas se deriva del
+# p99 observado en vez del valor fijo, y si la tasa de fallos (timeouts,
+# errores de conexión y 5xx) o los fallos consecutivos superan el umbral el
+# breaker se abre: las llamadas fallan de inmediato con 503 + Retry-After
+# hasta que pasa el enfriamiento y una única llamada de prueba (half-open)
+# decide si se cierra o vuelve a abrirse con el doble de espera. El estado
+# es por worker.
+N8N_BREAKER_WINDOW = int(os.getenv('N8N_BREAKER_WINDOW', '50'))
+N8N_BREAKER_MIN_CALLS = int(os.getenv('N8N_BREAKER_MIN_CALLS', '10'))
+N8N_BREAKER_FAILURE_RATE = float(os.getenv('N8N_BREAKER_FAILURE_RATE', '0.5'))
+N8N_BREAKER_CONSECUTIVE_FAILURES = int(os.getenv('N8N_BREAKER_CONSECUTIVE_FAILURES', '5'))
+N8N_BREAKER_COOLDOWN = float(os.getenv('N8N_BREAKER_COOLDOWN', '15'))
+N8N_BREAKER_MAX_COOLDOWN = float(os.getenv('N8N_BREAKER_MAX_COOLDOWN', '300'))
+N8N_TIMEOUT_MIN_SAMPLES = int(os.getenv('N8N_TIMEOUT_MIN_SAMPLES', '20'))
+N8N_TIMEOUT_MULTIPLIER = float(os.getenv('N8N_TIMEOUT_MULTIPLIER', '1.5'))
+N8N_TIMEOUT_MIN = float(os.getenv('N8N_TIMEOUT_MIN', '10'))
+
+class CircuitOpenError(Exception):
+    def __init__(self, webhook, retry_after):
+        super().__init__(f"Circuito abierto para {webhook}")
+        self.webhook = webhook
+        self.retry_after = max(1, round(retry_after))
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=N8N_BREAKER_WINDOW)  # (latencia, ok)
+        self._state = 'closed'
+        self._opened_at = 0.0
+        self._cooldown = N8N_BREAKER_COOLDOWN
+        self._consecutive_failures = 0
+        self._probing = False
+
+    def retry_after(self):
+        return self._opened_at + self._cooldown - time.time() if self._state == 'open' else 0
+
+    def before_call(self):
+        with self._lock:
+            if self._state == 'open':
+                remaining = self.retry_after()
+                if remaining > 0:
+                    metric_inc('n8n_breaker_rejected')
+                    raise CircuitOpenError(self.name, remaining)
+                self._state, self._probing = 'half_open', False
+            if self._state == 'half_open':
+                if self._probing:
+                    metric_inc('n8n_breaker_rejected')
+                    raise CircuitOpenError(self.name, 1)
+                self._probing = True
+
+    def record(self, latency, ok):
+        with self._lock:
+            self._calls.append((latency, ok))
+            if ok:
+                self._consecutive_failures = 0
+                if self._state == 'half_open':
+                    self._state, self._cooldown = 'closed', N8N_BREAKER_COOLDOWN
+                    self._calls.clear()
+                    app.logger.info(f"Circuito de {self.name} cerrado.")
+                return
+            self._consecutive_failures += 1
+            if self._state == 'half_open':
+                self._open(min(self._cooldown * 2, N8N_BREAKER_MAX_COOLDOWN))
+            elif self._state == 'closed' and (self._consecutive_failures >= N8N_BREAKER_CONSECUTIVE_FAILURES or self._failure_rate() >= N8N_BREAKER_FAILURE_RATE):
+                self._open(N8N_BREAKER_COOLDOWN)
+
+    def _failure_rate(self):
+        if len(self._calls) < N8N_BREAKER_MIN_CALLS:
+            return 0.0
+        return sum(1 for _, ok in self._calls if not ok) / len(self._calls)
+
+    def _open(self, cooldown):
+        self._state, self._opened_at, self._cooldown, self._probing = 'open', time.time(), cooldown, False
+        metric_inc('n8n_breaker_opened')
+        app.logger.warning(f"Circuito de {self.name} abierto durante {cooldown:.0f}s.")
+
+    def _percentile(self, q):
+        return percentile((latency for latency, _ in self._calls), q)
+
+    def timeout(self, floor, ceiling):
+        # Las llamadas que agotaron el timeout entran a la ventana con esa
+        # latencia, así que un n8n que se vuelve más lento empuja el p99 hacia
+        # el techo en vez de quedar cortado por un timeout demasiado corto.
+        with self._lock:
+            if len(self._calls) < N8N_TIMEOUT_MIN_SAMPLES:
+                return ceiling
+            return max(floor, min(ceiling, self._percentile(0.99) * N8N_TIMEOUT_MULTIPLIER))
+
+    def snapshot(self):
+        with self._lock:
+            return {'state': self._state, 'retry_after': max(0, round(self.retry_after())), 'calls': len(self._calls),
+                    'failure_rate': round(self._failure_rate(), 3), 'consecutive_failures': self._consecutive_failures,
+                    'p50': self._percentile(0.5), 'p99': self._percentile(0.99)}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def n8n_breaker(webhook):
+    breaker = _breakers.get(webhook)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(webhook, CircuitBreaker(webhook))
+    return breaker
+
+def n8n_open_webhooks():
+    return [name for name, breaker in list(_breakers.items()) if breaker.retry_after() > 0]
+
+def circuit_open_body(exc):
+    return {'error': 'El motor de IA no está disponible en este momento. Intenta nuevamente en unos segundos.',
+            'webhook': exc.webhook, 'retry_after': exc.retry_after}
+
+@app.errorhandler(CircuitOpenError)
+def circuit_open_response(exc):
+    response = make_response(jsonify(circuit_open_body(exc)), 503)
+    response.headers['Retry-After'] = str(exc.retry_after)
+    return response
+
+# --- EJECUCIONES DE N8N ---
+# Para detener una ejecución se usa la API pública de n8n (requiere N8N_API_KEY).
+# Los flujos actuales no devuelven su executionId (responden al recibir o con
+# sus propios items), así que las ejecuciones de un DI se buscan entre las que
+# siguen corriendo por el `di_id` que recibió su webhook, filtrando por el
+# workflow del webhook (ids de n8n_workflows/, que se conservan al importarlos).
+# Si un webhook llega a responder {"executionId": "{{$execution.id}}"}, ese id
+# se guarda en el outbox.
+N8N_API_KEY = os.getenv('N8N_API_KEY')
+N8N_EXECUTIONS_PAGE = int(os.getenv('N8N_EXECUTIONS_PAGE', '250'))
+N8N_WORKFLOW_IDS = {
+    'ingesta-di': '52dCBOagXgGB8bCy', 'validar-di': 'msK9bcfVZJNL1gV8',
+    'interaccion-ia': 'SwcZQBq59C3kBS6a', 'analyze-alignment': 'caMEGvf5lrn0kBvt',
+    **env_map('N8N_WORKFLOW_IDS'),
+}
+
+def n8n_execution_id(response):
+    if response is None: return None
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    execution_id = body.get('executionId') if isinstance(body, dict) else None
+    return str(execution_id) if execution_id else None
+
+def execution_di_id(execution):
+    # Sin EXECUTIONS_DATA_SAVE_ON_PROGRESS una ejecución en curso sólo guarda su
+    # pila inicial (executionData.nodeExecutionStack), que lleva el body del
+    # webhook; runData aparece al terminar o si se guarda el progreso.
+    data = execution.get('data') or {}
+    stack = (data.get('executionData') or {}).get('nodeExecutionStack') or []
+    run_data = (data.get('resultData') or {}).get('runData') or {}
+    for entry in [*stack, *(run for runs in run_data.values() for run in runs or [])]:
+        for items in ((entry.get('data') or {}).get('main') or []):
+            for item in items or []:
+                body = (item.get('json') or {}).get('body')
+                if isinstance(body, dict) and body.get('di_id'):
+                    return str(body['di_id'])
+    return None
+
+def running_n8n_executions(di_id, webhook=None):
+    # Devuelve None si no se pudo consultar n8n.
+    if not N8N_API_KEY:
+        return None
+    params = {'status': 'running', 'includeData': 'true', 'limit': N8N_EXECUTIONS_PAGE}
+    if N8N_WORKFLOW_IDS.get(webhook):
+        params['workflowId'] = N8N_WORKFLOW_IDS[webhook]
     try:
-        supabase_url = os.getenv("SUPABASE_URL")
-        service_key = os.getenv("SUPABASE_SERVICE_KEY")
-        if not supabase_url or not service_key:
-            app.logger.error("Broadcast fallido: Credenciales de Supabase no configuradas.")
+        with observe_dependency('n8n', 'list_executions'):
+            response = http_session().get(f"{N8N_BASE_URL.rstrip('/')}/api/v1/executions", headers={'X-N8N-API-KEY': N8N_API_KEY},
+                                          params=params, timeout=(OUTBOX_CONNECT_TIMEOUT, OUTBOX_READ_TIMEOUT))
+        response.raise_for_status()
+        executions = response.json().get('data') or []
+    except (requests.RequestException, ValueError) as e:
+        app.logger.warning(f"No se pudieron consultar las ejecuciones en curso de n8n: {str(e)}")
+        return None
+    return [str(execution['id']) for execution in executions if execution_di_id(execution) == str(di_id)]
+
+def stop_n8n_execution(execution_id):
+    if not N8N_API_KEY:
+        app.logger.warning(f"No se puede detener la ejecución {execution_id} de n8n: N8N_API_KEY no configurada.")
+        return False
+    try:
+        response = observed_post(http_session().post, 'n8n', 'stop_execution', f"{N8N_BASE_URL.rstrip('/')}/api/v1/executions/{execution_id}/stop",
+                                 headers={'X-N8N-API-KEY': N8N_API_KEY}, timeout=(OUTBOX_CONNECT_TIMEOUT, OUTBOX_READ_TIMEOUT))
+        response.raise_for_status()
+    except requests.RequestException as e:
+        app.logger.warning(f"No se pudo detener la ejecución {execution_id} de n8n: {str(e)}")
+        return False
+    metric_inc('n8n_executions_stopped')
+    return True
+
+class WebhookOutbox:
+    def __init__(self, workers):
+        self.workers = workers
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._wakeup = threading.Event()
+            self._last_cleanup = 0.0
+            self._last_release = 0.0
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f'outbox-worker-{i}', daemon=True).start()
+            self._pid = os.getpid()
+
+    def enqueue(self, webhook, payload, di_id=None, proceso=None, dedupe_key=None, concurrency_group=None):
+        # Con `dedupe_key`, un trabajo idéntico que aún está pendiente o en vuelo
+        # absorbe al nuevo: n8n ejecuta una sola vez y todos ven el mismo resultado.
+        with trace_span('outbox.enqueue', di_id=di_id, webhook=webhook):
+            trace_id, trace_parent = current_trace()
+            return self._enqueue(webhook, payload, di_id, proceso, dedupe_key, concurrency_group, trace_id, trace_parent)
+
+    def _enqueue(self, webhook, payload, di_id, proceso, dedupe_key, concurrency_group, trace_id, trace_parent):
+        now = time.time()
+        conn = state_db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            existing = None
+            if dedupe_key is not None:
+                existing = conn.execute(
+                    "SELECT id FROM outbox WHERE dedupe_key = ? AND status IN ('pending', 'in_flight')", (dedupe_key,)).fetchone()
+            if existing is None:
+                if di_id:
+                    # Un trabajo nuevo para el DI reemplaza a la ejecución anterior (reintento del reaper o proceso nuevo).
+                    conn.execute("UPDATE outbox SET status = 'done', updated_at = ? WHERE di_id = ? AND status = 'running'", (now, str(di_id)))
+                job_id = conn.execute(
+                    'INSERT INTO outbox (webhook, payload, di_id, proceso, dedupe_key, concurrency_group, lane, trace_id, trace_parent,'
+                    ' next_attempt_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (webhook, json.dumps(payload), str(di_id) if di_id else None, proceso, dedupe_key, concurrency_group,
+                     OUTBOX_LANES.get(webhook, OUTBOX_DEFAULT_LANE), trace_id, trace_parent, now, now, now)).lastrowid
+            else:
+                job_id = existing['id']
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if existing is not None:
+            metric_inc('outbox_deduplicated')
+            return job_id
+        metric_inc('outbox_enqueued')
+        self._ensure_started()
+        self._wakeup.set()
+        return job_id
+
+    def _claim(self):
+        conn = state_db()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            reclaimed = conn.execute(
+                "UPDATE outbox SET status = 'pending', updated_at = ? WHERE status = 'in_flight' AND lease_until < ?",
+                (now, now)).rowcount
+            if reclaimed:
+                metric_inc('outbox_reclaimed', reclaimed)
+            # Se excluyen en SQL los webhooks y grupos ya saturados, para que una
+            # cola larga de un tipo no tape a los trabajos de otro.
+            in_flight = dict(conn.execute(
+                "SELECT webhook, COUNT(*) FROM outbox WHERE status IN ('in_flight', 'running') GROUP BY webhook").fetchall())
+            saturated = [webhook for webhook, count in in_flight.items()
+                         if count >= webhook_concurrency(webhook)] + n8n_open_webhooks()
+            groups_in_flight = dict(conn.execute(
+                "SELECT concurrency_group, COUNT(*) FROM outbox WHERE status IN ('in_flight', 'running') AND concurrency_group IS NOT NULL "
+                "GROUP BY concurrency_group").fetchall())
+            saturated_groups = [group for group, count in groups_in_flight.items()
+                                if count >= OUTBOX_GROUP_CONCURRENCY.get(group, OUTBOX_DEFAULT_CONCURRENCY)]
+            lanes_in_flight = dict(conn.execute(
+                "SELECT lane, COUNT(*) FROM outbox WHERE status IN ('in_flight', 'running') GROUP BY lane").fetchall())
+            saturated_lanes = [lane for lane, count in lanes_in_flight.items() if count >= lane_concurrency(lane)]
+            job = conn.execute(
+                f"SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ?"
+                f" AND webhook NOT IN ({','.join('?' * len(saturated))})"
+                f" AND (concurrency_group IS NULL OR concurrency_group NOT IN ({','.join('?' * len(saturated_groups))}))"
+                f" AND lane NOT IN ({','.join('?' * len(saturated_lanes))})"
+                f" ORDER BY next_attempt_at - CASE lane {' '.join('WHEN ? THEN ?' for _ in OUTBOX_LANE_HEAD_START)} ELSE 0 END, id LIMIT 1",
+                (now, *saturated, *saturated_groups, *saturated_lanes,
+                 *(value for item in OUTBOX_LANE_HEAD_START.items() for value in item))).fetchone()
+            if job is not None:
+                conn.execute(
+                    "UPDATE outbox SET status = 'in_flight', attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?",
+                    (now + OUTBOX_LEASE_SECONDS, now, job['id']))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if job is not None:
+            # Espera desde que el trabajo quedó listo (alta o fin del backoff) hasta que un worker lo toma.
+            waited = now - (job['created_at'] if job['attempts'] == 0 else job['next_attempt_at'])
+            _metrics.observe('outbox_lane_wait_seconds', (('lane', job['lane']),), max(0.0, waited))
+            metric_inc(f"outbox_lane_{job['lane']}_claimed")
+        return job
+
+    def lane_stats(self):
+        # Desde el histograma combinado de todos los workers (el mismo de /metrics):
+        # los percentiles son el límite superior del bucket que los contiene.
+        _metrics._ensure_started()
+        _metrics.flush()
+        histograms, _, _ = _merge_metric_files()
+        return {dict(labels)['lane']: {'claimed': sum(counts), 'wait_p50': histogram_quantile(counts, 0.5),
+                                       'wait_p95': histogram_quantile(counts, 0.95)}
+                for (name, labels), (counts, _) in histograms.items() if name == 'outbox_lane_wait_seconds'}
+
+    def _deliver(self, job):
+        # El timeout de lectura queda fijo: un ReadTimeout se da por entregado,
+        # y acortarlo según el p99 sólo multiplicaría esas entregas a ciegas.
+        breaker = n8n_breaker(job['webhook'])
+        breaker.before_call()
+        started, ok = time.monotonic(), False
+        try:
+            response = observed_post(
+                http_session().post, 'n8n', job['webhook'], n8n_webhook_url(job['webhook']), json=with_trace(json.loads(job['payload'])),
+                timeout=(OUTBOX_CONNECT_TIMEOUT, OUTBOX_READ_TIMEOUT))
+            ok = response.status_code < 500
+        except requests.exceptions.ReadTimeout:
+            # n8n ya recibió la petición y el flujo sigue corriendo: reintentar
+            # sólo duplicaría la ejecución.
+            ok = True
+            return None
+        finally:
+            breaker.record(time.monotonic() - started, ok)
+        response.raise_for_status()
+        return response
+
+    def _defer(self, job, delay):
+        # Circuito abierto: el intento no cuenta y el trabajo vuelve a la cola.
+        now = time.time()
+        state_db().execute(
+            "UPDATE outbox SET status = 'pending', attempts = attempts - 1, lease_until = NULL, next_attempt_at = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'in_flight'", (now + delay, now, job['id']))
+        metric_inc('outbox_deferred')
+
+    def _complete(self, job, execution_id=None):
+        status = 'running' if job['di_id'] and job['proceso'] else 'done'
+        completed = state_db().execute(
+            "UPDATE outbox SET status = ?, execution_id = ?, last_error = NULL, updated_at = ? WHERE id = ? AND status = 'in_flight'",
+            (status, execution_id, time.time(), job['id'])).rowcount
+        if completed:
+            metric_inc('outbox_delivered')
+        elif job['di_id']:
+            # Se canceló mientras se entregaba: la ejecución recién creada también sobra.
+            if execution_id:
+                state_db().execute("UPDATE outbox SET execution_id = ? WHERE id = ?", (execution_id, job['id']))
+            for running_id in [execution_id] if execution_id else (running_n8n_executions(job['di_id'], job['webhook']) or []):
+                stop_n8n_execution(running_id)
+
+    def _fail(self, job, error):
+        attempts = job['attempts'] + 1
+        now = time.time()
+        if attempts < OUTBOX_MAX_ATTEMPTS:
+            delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)))
+            if not state_db().execute(
+                    "UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ? AND status = 'in_flight'",
+                    (now + delay, error, now, job['id'])).rowcount:
+                return  # cancelado mientras se entregaba
+            metric_inc('outbox_retries')
+            app.logger.warning(f"Webhook {job['webhook']} falló (intento {attempts}), reintento en {delay:.0f}s: {error}")
+            return
+        if not state_db().execute("UPDATE outbox SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ? AND status = 'in_flight'",
+                                  (error, now, job['id'])).rowcount:
+            return
+        metric_inc('outbox_failed')
+        app.logger.error(f"Webhook {job['webhook']} descartado tras {attempts} intentos: {error}")
+        if job['di_id'] and job['proceso']:
+            try:
+                mark_proceso_error(get_supabase(), job['di_id'], job['proceso'], "No se pudo contactar al motor de IA.")
+            except Exception as e:
+                app.logger.error(f"No se pudo marcar el DI {job['di_id']} con error: {str(e)}")
+
+    def release(self, di_ids):
+        di_ids = [str(di_id) for di_id in di_ids]
+        released = state_db().execute(
+            f"UPDATE outbox SET status = 'done', updated_at = ? WHERE status = 'running' AND di_id IN ({','.join('?' * len(di_ids))})",
+            (time.time(), *di_ids)).rowcount
+        if released:
+            metric_inc('outbox_released', released)
+            if self._pid == os.getpid():
+                self._wakeup.set()
+        return released
+
+    def _release_finished(self):
+        # Libera los cupos de ejecuciones que ya terminaron en n8n.
+        now = time.time()
+        if now - self._last_release < OUTBOX_RUNNING_POLL:
+            return
+        self._last_release = now
+        rows = state_db().execute("SELECT di_id, proceso, updated_at FROM outbox WHERE status = 'running'").fetchall()
+        if not rows or not acquire_lease('outbox-running-poll', OUTBOX_RUNNING_POLL):
+            return
+        try:
+            actuales = procesos_actuales(get_supabase(), list({row['di_id'] for row in rows}))
+        except Exception as e:
+            app.logger.warning(f"No se pudo revisar el estado de {len(rows)} ejecución(es) de n8n: {str(e)}")
+            actuales = None
+        finished = []
+        for row in rows:
+            if now - row['updated_at'] > PROCESS_DEADLINES.get(row['proceso'], PROCESS_STALE_SECONDS):
+                finished.append(row['di_id'])  # el reaper se encarga del DI
+            elif actuales is not None:
+                proceso = actuales.get(row['di_id'])  # None si el DI ya no existe
+                if not proceso or proceso.get('nombre') != row['proceso'] or proceso.get('estado') != 'processing':
+                    finished.append(row['di_id'])
+        if finished:
+            self.release(finished)
+
+    def _cleanup(self):
+        now = time.time()
+        if now - self._last_cleanup < 300:
             return
+        self._last_cleanup = now
+        state_db().execute("DELETE FROM outbox WHERE status IN ('done', 'failed', 'cancelled') AND updated_at < ?",
+                           (now - OUTBOX_RETENTION_SECONDS,))
+        state_db().execute('DELETE FROM trace_spans WHERE end_time < ?', (now - TRACE_RETENTION_SECONDS,))
+
+    def _run(self):
+        while True:
+            try:
+                self._release_finished()
+                job = self._claim()
+                if job is None:
+                    self._cleanup()
+                    self._wakeup.wait(1.0)
+                    self._wakeup.clear()
+                    continue
+                with trace_context(job['trace_id'], job['trace_parent']):
+                    self._handle(job)
+            except Exception as e:
+                app.logger.error(f"Error en el worker del outbox: {str(e)}")
+                time.sleep(1.0)
+
+    def _handle(self, job):
+        trace_id, parent_id = current_trace()
+        queued_since = job['created_at'] if job['attempts'] == 0 else job['next_attempt_at']
+        record_span(trace_id, new_span_id(), parent_id, 'outbox.queue_wait', queued_since, time.time(), di_id=job['di_id'],
+                    attributes={'webhook': job['webhook'], 'lane': job['lane'], 'attempt': job['attempts'] + 1})
+        with trace_span(f"n8n.webhook {job['webhook']}", di_id=job['di_id'], attempt=job['attempts'] + 1):
+            try:
+                response = self._deliver(job)
+            except CircuitOpenError as e:
+                self._defer(job, e.retry_after)
+            except Exception as e:
+                self._fail(job, str(e))
+            else:
+                self._complete(job, n8n_execution_id(response))
+
+    def delivered(self, di_id, proceso, since):
+        # Cuántas veces se entregó este proceso a n8n desde `since`.
+        return state_db().execute(
+            "SELECT COUNT(*) FROM outbox WHERE di_id = ? AND proceso = ? AND status IN ('done', 'running') AND updated_at >= ?",
+            (str(di_id), proceso, since)).fetchone()[0]
+
+    def cancel(self, di_id):
+        # Retira los trabajos del DI aún no entregados o en curso.
+        cancelled = state_db().execute(
+            "UPDATE outbox SET status = 'cancelled', lease_until = NULL, updated_at = ? WHERE di_id = ? AND status IN ('pending', 'in_flight', 'running')",
+            (time.time(), str(di_id))).rowcount
+        metric_inc('outbox_cancelled', cancelled)
+        return cancelled
 
-        broadcast_url = f"{supabase_url}/realtime/v1/api/broadcast"
-        headers = {"apikey": service_key, "Content-Type": "application/json"}
-        payload = {
-            "messages": [{"topic": "di_changes", "event": "di_update", "payload": {
-                "eventType": event_type, "new": new_data, "old": old_data
-            }}]
+    def last_job(self, di_id, proceso):
+        row = state_db().execute(
+            "SELECT webhook, payload, execution_id, concurrency_group FROM outbox WHERE di_id = ? AND proceso = ? ORDER BY id DESC LIMIT 1",
+            (str(di_id), proceso)).fetchone()
+        return dict(row) if row else None
+
+    def shared_job(self, di_id, dedupe_key):
+        # Trabajo idéntico del DI que sigue pendiente, en vuelo o ejecutándose en n8n.
+        row = state_db().execute(
+            "SELECT id, webhook, proceso, status, attempts, created_at FROM outbox WHERE di_id = ? AND dedupe_key = ? "
+            "AND status IN ('pending', 'in_flight', 'running') ORDER BY id DESC LIMIT 1", (str(di_id), dedupe_key)).fetchone()
+        return dict(row) if row else None
+
+    def active_job(self, di_id):
+        row = state_db().execute(
+            "SELECT id, webhook, proceso, status, attempts, created_at FROM outbox WHERE di_id = ? AND status IN ('pending', 'in_flight') "
+            "ORDER BY id DESC LIMIT 1", (str(di_id),)).fetchone()
+        return dict(row) if row else None
+
+    def snapshot(self):
+        conn = state_db()
+        counts = defaultdict(dict)
+        for row in conn.execute('SELECT status, webhook, COUNT(*) AS n FROM outbox GROUP BY status, webhook'):
+            counts[row['status']][row['webhook']] = row['n']
+        in_flight_jobs = [dict(row) for row in conn.execute(
+            "SELECT id, webhook, di_id, proceso, lane, attempts, lease_until, created_at FROM outbox WHERE status = 'in_flight' ORDER BY id")]
+        lanes = {lane: {'pending': 0, 'in_flight': 0, 'running': 0, 'concurrency': lane_concurrency(lane),
+                        'head_start': OUTBOX_LANE_HEAD_START.get(lane, 0.0)}
+                 for lane in {*OUTBOX_LANE_CONCURRENCY, *OUTBOX_LANES.values(), OUTBOX_DEFAULT_LANE}}
+        for row in conn.execute("SELECT lane, status, COUNT(*) AS n FROM outbox WHERE status IN ('pending', 'in_flight', 'running') GROUP BY lane, status"):
+            lanes.setdefault(row['lane'], {})[row['status']] = row['n']
+        for lane, waits in self.lane_stats().items():
+            lanes.setdefault(lane, {}).update(waits)
+        return {
+            'queue_depth': sum(counts.get('pending', {}).values()),
+            'in_flight': len(in_flight_jobs),
+            'running': sum(counts.get('running', {}).values()),
+            'failed': sum(counts.get('failed', {}).values()),
+            'by_status': counts,
+            'in_flight_jobs': in_flight_jobs,
+            'workers_per_process': self.workers,
+            'concurrency': {webhook: webhook_concurrency(webhook) for webhook in {*PROCESS_WEBHOOKS.values(), *OUTBOX_LANES, *OUTBOX_CONCURRENCY}},
+            'group_concurrency': OUTBOX_GROUP_CONCURRENCY,
+            'lanes': lanes,
         }
-        requests.post(broadcast_url, json=payload, headers=headers, timeout=3)
-        app.logger.info(f"Broadcast enviado para evento: {event_type}")
-    except Exception as e:
-        app.logger.error(f"Error al enviar broadcast: {str(e)}")
+
+_outbox = WebhookOutbox(OUTBOX_WORKERS)
+
+def enqueue_webhook(webhook, payload, di_id=None, proceso=None, dedupe_key=None, concurrency_group=None):
+    return _outbox.enqueue(webhook, payload, di_id=di_id, proceso=proceso, dedupe_key=dedupe_key, concurrency_group=concurrency_group)
+
+@app.before_request
+def _start_background_workers():
+    # Arranca los hilos del worker actual aunque aún no haya encolado nada,
+    # para drenar trabajos que quedaron pendientes de una ejecución anterior.
+    _outbox._ensure_started()
+    _reaper._ensure_started()
+
+# --- CLIENTE DE SUPABASE COMPARTIDO ---
+# Un único cliente por proceso (worker de gunicorn). El cliente mantiene sus
+# sesiones httpx con keep-alive, así que las peticiones reutilizan conexiones
+# en lugar de pagar la construcción del cliente y un handshake nuevo cada vez.
+# Se indexa por PID para que un fork nunca herede el pool del proceso padre.
+_supabase_clients = {}
+_supabase_lock = threading.Lock()
+
+def get_supabase() -> Client:
+    pid = os.getpid()
+    client = _supabase_clients.get(pid)
+    if client is not None:
+        return client
+    with _supabase_lock:
+        client = _supabase_clients.get(pid)
+        if client is None:
+            client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_KEY"))
+            # Los sub-clientes se crean de forma perezosa y sin lock; los
+            # inicializamos aquí para que los hilos no compitan al crearlos.
+            instrument_httpx(client.postgrest.session, 'supabase', lambda req: f"{req.method} {req.url.path.rsplit('/', 1)[-1]}")
+            instrument_httpx(client.storage._client, 'storage', lambda req: req.method)
+            _supabase_clients.clear()
+            _supabase_clients[pid] = client
+    return client
+
+# --- SUBIDA A STORAGE POR BLOQUES ---
+# El archivo nunca se lee completo en memoria: los pequeños van en una sola
+# petición y los grandes por el endpoint reanudable (TUS) de Supabase Storage,
+# bloque a bloque. Si un bloque falla se consulta el offset confirmado y se
+# continúa desde ahí.
+STORAGE_BUCKET = 'di-bucket'
+# Supabase exige bloques de exactamente 6 MB (salvo el último) en subidas TUS.
+STORAGE_CHUNK_SIZE = 6 * 1024 * 1024
+STORAGE_CHUNK_RETRIES = 3
+
+_http_local = threading.local()
+
+def http_session():
+    # Una sesión keep-alive por hilo; requests.Session no es segura entre hilos.
+    session = getattr(_http_local, 'session', None)
+    if session is None or _http_local.pid != os.getpid():
+        session = _http_local.session = requests.Session()
+        _http_local.pid = os.getpid()
+    return session
+
+def stream_size(stream):
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+def sha256_stream(stream):
+    stream.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def upload_to_storage(supabase, stream, path, content_type):
+    stream.seek(0)
+    size = stream_size(stream)
+    if size <= STORAGE_CHUNK_SIZE:
+        supabase.storage.from_(STORAGE_BUCKET).upload(file=stream.read(), path=path, file_options={"content-type": content_type})
+    else:
+        with observe_dependency('storage', 'tus_upload'):
+            _tus_upload(stream, size, path, content_type)
+    metric_inc('storage_uploaded_bytes', size)
+
+def _tus_upload(stream, size, path, content_type):
+    service_key = os.getenv('SUPABASE_SERVICE_KEY')
+    headers = {'Authorization': f'Bearer {service_key}', 'apikey': service_key, 'Tus-Resumable': '1.0.0'}
+    metadata = {'bucketName': STORAGE_BUCKET, 'objectName': path, 'contentType': content_type or 'application/octet-stream'}
+    session = http_session()
+
+    endpoint = f"{os.getenv('SUPABASE_URL')}/storage/v1/upload/resumable"
+    created = session.post(endpoint, timeout=30, headers={
+        **headers,
+        'Upload-Length': str(size),
+        'Upload-Metadata': ','.join(f"{key} {base64.b64encode(value.encode()).decode()}" for key, value in metadata.items()),
+    })
+    if created.status_code == 409:
+        raise Exception(f'Duplicate: {path}')
+    created.raise_for_status()
+    upload_url = urljoin(endpoint, created.headers['Location'])
+
+    offset, failures = 0, 0
+    while offset < size:
+        chunk = stream.read(STORAGE_CHUNK_SIZE)
+        if not chunk:
+            raise Exception('El archivo terminó antes de lo esperado.')
+        try:
+            response = session.patch(upload_url, data=chunk, timeout=60, headers={
+                **headers, 'Upload-Offset': str(offset), 'Content-Type': 'application/offset+octet-stream',
+            })
+            response.raise_for_status()
+            offset = int(response.headers.get('Upload-Offset', offset + len(chunk)))
+        except requests.exceptions.RequestException:
+            failures += 1
+            if failures > STORAGE_CHUNK_RETRIES:
+                raise
+            metric_inc('storage_chunk_retries')
+            head = session.head(upload_url, headers=headers, timeout=30)
+            head.raise_for_status()
+            offset = int(head.headers['Upload-Offset'])
+        stream.seek(offset)
+
+# --- CACHE DE JWT VERIFICADOS ---
+# El frontend repite el mismo token en cada sondeo; lo verificamos una sola vez
+# por worker. La clave es el digest del token (nunca el token en claro) y la
+# entrada vive como máximo hasta su `exp`. Los tokens inválidos no se cachean.
+JWT_CACHE_MAX_TTL = int(os.getenv('JWT_CACHE_MAX_TTL', '300'))
+_jwt_cache = TTLCache('jwt_cache', maxsize=int(os.getenv('JWT_CACHE_SIZE', '1024')), ttl=JWT_CACHE_MAX_TTL)
+
+@register_stats('jwt_cache')
+def _jwt_cache_stats():
+    return {'size': len(_jwt_cache), 'maxsize': _jwt_cache.maxsize}
+
+def verify_token(token):
+    token_digest = hashlib.sha256(token.encode()).hexdigest()
+    claims = _jwt_cache.get(token_digest)
+    # Re-comprobamos `exp` con el reloj de pared: si ya venció, dejamos que
+    # jwt.decode lo rechace con el mismo error de siempre.
+    if claims is not None and ('exp' not in claims or time.time() < claims['exp']):
+        return claims
+
+    with observe_dependency('jwt', 'decode'):
+        decoded_token = jwt.decode(token, os.getenv('SUPABASE_JWT_SECRET'), algorithms=['HS256'], audience='authenticated')
+    claims = {
+        'sub': decoded_token['sub'],
+        'role': decoded_token.get('user_metadata', {}).get('role', 'docente'),
+        'exp': decoded_token.get('exp'),
+    }
+    ttl = JWT_CACHE_MAX_TTL
+    if claims['exp'] is not None:
+        ttl = min(ttl, claims['exp'] - time.time())
+    else:
+        del claims['exp']
+    if ttl > 0:
+        _jwt_cache.set(token_digest, claims, ttl=ttl)
+    return claims
 
 def token_required(f):
     @wraps(f)
@@ -53,15 +1446,12 @@ def token_required(f):
             token = auth_header.split(' ')[1]
         if not token: return jsonify({'message': 'Token de autorización ausente o inválido.'}), 401
         try:
-            SUPABASE_JWT_SECRET = os.getenv('SUPABASE_JWT_SECRET')
-            decoded_token = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=['HS256'], audience='authenticated')
+            claims = verify_token(token)
             
-            g.user_id = decoded_token['sub']
-            g.user_role = decoded_token.get('user_metadata', {}).get('role', 'docente')
+            g.user_id = claims['sub']
+            g.user_role = claims['role']
             
-            SUPABASE_URL = os.getenv("SUPABASE_URL")
-            SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
-            g.supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+            g.supabase = get_supabase()
         except Exception as e:
             return jsonify({'message': f'Token inválido o error: {str(e)}'}), 401
         return f(*args, **kwargs)
@@ -77,20 +1467,1076 @@ def require_role(role_name):
         return decorated_function
     return decorator
 
+# --- CONTROL DE ADMISIÓN (TOKEN BUCKET POR USUARIO) ---
+# Cada usuario tiene un bucket por clase de ruta: 'interactive' (generación,
+# revisión, consultas) y 'batch' (validación y análisis, que en los disparos
+# masivos cuestan un token por DI). Formato "capacidad/segundos": el bucket se
+# rellena por completo en ese período. Los buckets viven en la base SQLite
+# compartida, así el presupuesto es del contenedor y no de cada worker; con
+# RATE_LIMIT_BACKEND=postgres se guardan en DATABASE_URL y se comparten entre
+# réplicas. Si el almacén falla se deja pasar la petición. Los admins pagan
+# igual en las rutas de generación; las de /api/sync/* no se limitan. Los validadores
+# baratos (400) corren antes de cobrar; si la petición no llega a lanzar nada
+# porque el DI ya tiene un proceso en curso (409), se devuelven los tokens.
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'sqlite')
+
+def rate_limit_spec(name, default):
+    capacity, period = os.getenv(name, default).split('/')
+    return float(capacity), float(capacity) / float(period)
+
+RATE_LIMITS = {
+    'interactive': rate_limit_spec('RATE_LIMIT_INTERACTIVE', '10/60'),
+    'batch': rate_limit_spec('RATE_LIMIT_BATCH', '200/3600'),
+}
+
+RATE_LIMIT_SQL = {
+    'sqlite': ("INSERT INTO rate_buckets (key, tokens, updated_at) VALUES (:key, :capacity - :cost, :now) "
+               "ON CONFLICT(key) DO UPDATE SET tokens = MIN(:capacity, tokens + (:now - updated_at) * :rate) - :cost, updated_at = :now "
+               "WHERE MIN(:capacity, tokens + (:now - updated_at) * :rate) >= :cost RETURNING tokens",
+               "SELECT MIN(:capacity, tokens + (:now - updated_at) * :rate) FROM rate_buckets WHERE key = :key",
+               "UPDATE rate_buckets SET tokens = MIN(:capacity, tokens + :cost) WHERE key = :key"),
+    'postgres': ("INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at) VALUES (%(key)s, %(capacity)s - %(cost)s, %(now)s) "
+                 "ON CONFLICT (key) DO UPDATE SET tokens = LEAST(%(capacity)s, b.tokens + (%(now)s - b.updated_at) * %(rate)s) - %(cost)s, "
+                 "updated_at = %(now)s WHERE LEAST(%(capacity)s, b.tokens + (%(now)s - b.updated_at) * %(rate)s) >= %(cost)s RETURNING tokens",
+                 "SELECT LEAST(%(capacity)s, tokens + (%(now)s - updated_at) * %(rate)s) FROM rate_limit_buckets WHERE key = %(key)s",
+                 "UPDATE rate_limit_buckets SET tokens = LEAST(%(capacity)s, tokens + %(cost)s) WHERE key = %(key)s"),
+}
+_pg_local = threading.local()
+
+def rate_limit_db():
+    if RATE_LIMIT_BACKEND != 'postgres':
+        return state_db()
+    conn = getattr(_pg_local, 'conn', None)
+    if conn is None or conn.closed or _pg_local.pid != os.getpid():
+        import psycopg2
+        conn = psycopg2.connect(os.getenv('DATABASE_URL'), connect_timeout=3)
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("CREATE TABLE IF NOT EXISTS rate_limit_buckets (key TEXT PRIMARY KEY, tokens DOUBLE PRECISION NOT NULL, "
+                        "updated_at DOUBLE PRECISION NOT NULL)")
+        _pg_local.conn, _pg_local.pid = conn, os.getpid()
+    return conn
+
+def take_tokens(key, route_class, cost):
+    # 0 si se admitió la petición; si no, los segundos hasta tener saldo.
+    capacity, rate = RATE_LIMITS[route_class]
+    params = {'key': key, 'capacity': capacity, 'rate': rate, 'cost': min(cost, capacity), 'now': time.time()}
+    take_sql, peek_sql, _ = RATE_LIMIT_SQL['postgres' if RATE_LIMIT_BACKEND == 'postgres' else 'sqlite']
+    cur = rate_limit_db().cursor()
+    try:
+        cur.execute(take_sql, params)
+        if cur.fetchone() is not None:
+            return 0
+        cur.execute(peek_sql, params)
+        available = cur.fetchone()[0]
+        return (params['cost'] - available) / rate
+    finally:
+        cur.close()
+
+def give_back_tokens(key, route_class, cost):
+    capacity, _ = RATE_LIMITS[route_class]
+    cur = rate_limit_db().cursor()
+    try:
+        cur.execute(RATE_LIMIT_SQL['postgres' if RATE_LIMIT_BACKEND == 'postgres' else 'sqlite'][2],
+                    {'key': key, 'capacity': capacity, 'cost': min(cost, capacity)})
+    finally:
+        cur.close()
+
+_limiter_by_user = defaultdict(lambda: defaultdict(int))
+
+@register_stats('rate_limiter')
+def _rate_limiter_stats():
+    with _metrics_lock:
+        by_user = {user_id: dict(counts) for user_id, counts in _limiter_by_user.items()}
+    return {'backend': RATE_LIMIT_BACKEND, 'limits': RATE_LIMITS, 'by_user': by_user}
+
+def rate_limit_response(route_class, cost=1):
+    if RATE_LIMIT_BACKEND == 'off':
+        return None
+    try:
+        wait = take_tokens(f"{g.user_id}:{route_class}", route_class, cost)
+    except Exception as e:
+        app.logger.error(f"Limitador no disponible, se admite la petición: {str(e)}")
+        metric_inc('rate_limit_errors')
+        return None
+    outcome = 'rejected' if wait > 0 else 'allowed'
+    metric_inc(f'rate_limit_{outcome}')
+    with _metrics_lock:
+        _limiter_by_user[g.user_id][f'{route_class}_{outcome}'] += 1
+    if not wait:
+        g.rate_limit_charge = (route_class, cost)
+        return None
+    response = make_response(jsonify({'message': 'Demasiadas solicitudes. Intenta nuevamente en unos segundos.',
+                                      'route_class': route_class, 'retry_after': max(1, round(wait))}), 429)
+    response.headers['Retry-After'] = str(max(1, round(wait)))
+    return response
+
+def refund_rate_limit(cost=None):
+    # Devuelve lo cobrado por rate_limit_response en esta petición (o parte de ello).
+    charge = g.pop('rate_limit_charge', None)
+    if charge is None:
+        return
+    route_class, charged = charge
+    try:
+        give_back_tokens(f"{g.user_id}:{route_class}", route_class, charged if cost is None else min(cost, charged))
+    except Exception as e:
+        app.logger.error(f"No se pudieron devolver tokens al limitador: {str(e)}")
+        return
+    metric_inc('rate_limit_refunded')
+
+# --- IDEMPOTENCIA DE DISPAROS (Idempotency-Key) ---
+# Un reintento del frontend tras un corte de red no debe lanzar otra cadena de
+# LLM. Con la cabecera `Idempotency-Key`, la primera petición reserva la clave
+# (por usuario y ruta) en la base local y guarda su respuesta durante
+# IDEMPOTENCY_TTL; las repeticiones reciben esa misma respuesta sin volver a
+# despachar, y las que llegan mientras la primera sigue en curso la esperan.
+# Las respuestas 5xx y 429 no se guardan: el reintento vuelve a ejecutarse.
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '86400'))
+IDEMPOTENCY_LOCK_SECONDS = float(os.getenv('IDEMPOTENCY_LOCK_SECONDS', '60'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '15'))
+
+def idempotency_claim(key, fingerprint):
+    # Reserva la clave si no existe o si expiró (incluida la reserva de un
+    # worker que murió antes de guardar su respuesta).
+    now = time.time()
+    conn = state_db()
+    conn.execute('DELETE FROM idempotency_keys WHERE expires_at < ?', (now,))
+    return conn.execute(
+        "INSERT INTO idempotency_keys (key, fingerprint, status, created_at, expires_at) VALUES (?, ?, 'pending', ?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET fingerprint = excluded.fingerprint, status = 'pending', http_status = NULL, "
+        "content_type = NULL, body = NULL, created_at = excluded.created_at, expires_at = excluded.expires_at "
+        "WHERE idempotency_keys.expires_at < excluded.created_at",
+        (key, fingerprint, now, now + IDEMPOTENCY_LOCK_SECONDS)).rowcount > 0
+
+def idempotency_wait(key):
+    deadline = time.time() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        row = state_db().execute('SELECT * FROM idempotency_keys WHERE key = ?', (key,)).fetchone()
+        if row is None or row['status'] == 'done' or time.time() >= deadline:
+            return row
+        time.sleep(0.1)
+
+def idempotent(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if not client_key:
+            return f(*args, **kwargs)
+        if len(client_key) > 255:
+            return jsonify({'message': 'Idempotency-Key demasiado larga.'}), 400
+        key = hashlib.sha256(f"{g.user_id}:{request.method}:{request.path}:{client_key}".encode()).hexdigest()
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+
+        if not idempotency_claim(key, fingerprint):
+            row = idempotency_wait(key)
+            if row is not None and row['fingerprint'] != fingerprint:
+                return jsonify({'message': 'La Idempotency-Key ya se usó con otra solicitud.'}), 422
+            if row is None or row['status'] != 'done':
+                metric_inc('idempotency_in_progress')
+                response = make_response(jsonify({'message': 'La solicitud original sigue en curso.'}), 409)
+                response.headers['Retry-After'] = '1'
+                return response
+            metric_inc('idempotency_replayed')
+            response = Response(row['body'], status=row['http_status'], content_type=row['content_type'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            state_db().execute('DELETE FROM idempotency_keys WHERE key = ?', (key,))
+            raise
+        if response.status_code >= 500 or response.status_code == 429:
+            state_db().execute('DELETE FROM idempotency_keys WHERE key = ?', (key,))
+        else:
+            state_db().execute(
+                "UPDATE idempotency_keys SET status = 'done', http_status = ?, content_type = ?, body = ?, expires_at = ? WHERE key = ?",
+                (response.status_code, response.content_type, response.get_data(), time.time() + IDEMPOTENCY_TTL, key))
+        return response
+    return decorated
+
+# --- CACHE DE METADATOS DE DI ---
+# Propietario, nombre de archivo y estructura MEI casi nunca cambian; se leen
+# en una sola consulta y se guardan por worker. broadcast_change invalida la
+# entrada de cada DI que notifica, así que un borrado o una actualización hecha
+# por este worker se ve de inmediato; el TTL acota lo que otro worker cambió.
+_di_meta_cache = TTLCache('di_meta_cache', maxsize=int(os.getenv('DI_META_CACHE_SIZE', '2048')), ttl=float(os.getenv('DI_META_CACHE_TTL', '30')))
+
+@register_stats('di_meta_cache')
+def _di_meta_cache_stats():
+    return {'size': len(_di_meta_cache), 'maxsize': _di_meta_cache.maxsize}
+
+DI_META_COLUMNS = ('id_usuario', 'nombre_archivo', 'estructura_mei')
+
+def sync_di_meta(event_type, new_data=None, old_data=None):
+    # Si el evento trae la fila completa se refresca la entrada; si no, se descarta.
+    di_id = (new_data or {}).get('id_di') or (old_data or {}).get('id_di')
+    if not di_id:
+        return
+    if event_type != 'DELETE' and new_data and all(column in new_data for column in DI_META_COLUMNS):
+        _di_meta_cache.set(str(di_id), {column: new_data[column] for column in DI_META_COLUMNS})
+        metric_inc('di_meta_cache_refreshes')
+    elif _di_meta_cache.pop(str(di_id)) is not None:
+        metric_inc('di_meta_cache_invalidations')
+
 def check_di_ownership(di_id):
+    di_meta = _di_meta_cache.get(str(di_id))
+    if di_meta is None:
+        try:
+            result = g.supabase.table('disenos_instruccionales').select('id_usuario, nombre_archivo, estructura_mei').eq('id_di', str(di_id)).single().execute()
+        except Exception:
+            return None
+        if not result.data:
+            return None
+        di_meta = result.data
+        _di_meta_cache.set(str(di_id), di_meta)
+    return dict(di_meta) if di_meta['id_usuario'] == g.user_id else None
+
+# --- LLAMADAS SÍNCRONAS A N8N (GENERACIÓN / REVISIÓN) ---
+N8N_SYNC_TIMEOUT = float(os.getenv('N8N_SYNC_TIMEOUT', '120'))
+
+def call_n8n(webhook, data):
+    breaker = n8n_breaker(webhook)
+    breaker.before_call()
+    started, ok = time.monotonic(), False
+    try:
+        with trace_span(f'n8n.call {webhook}'):
+            response = observed_post(requests.post, 'n8n', webhook, n8n_webhook_url(webhook), json=with_trace(data),
+                                     headers={'Content-Type': 'application/json'}, timeout=breaker.timeout(N8N_TIMEOUT_MIN, N8N_SYNC_TIMEOUT))
+        ok = response.status_code < 500
+    finally:
+        breaker.record(time.monotonic() - started, ok)
+    response.raise_for_status()
+    return response.json(), response.status_code
+
+def save_generation(supabase, user_id, data, output_data, etiqueta):
+    try:
+        supabase.table('generaciones_ia').insert({'user_id': user_id, 'input_data': data, 'output_data': output_data}).execute()
+    except Exception as e:
+        app.logger.warning(f"ADVERTENCIA: No se pudo guardar la {etiqueta} en la DB: {e}")
+
+def n8n_error_response(exc, origen):
+    if isinstance(exc, requests.exceptions.Timeout):
+        return {"error": "La solicitud al motor de revisión tardó demasiado en responder"}, 504
+    if isinstance(exc, requests.exceptions.HTTPError):
+        app.logger.error(f"Error de n8n ({origen}): {exc} - {exc.response.text}")
+        return {'error': f"Error de n8n: {exc}", 'n8n_response': exc.response.text}, exc.response.status_code
+    app.logger.error(f"Error de conexión ({origen}): {exc}")
+    return {'error': f"Error de conexión: {exc}"}, 500
+
+# --- SINGLE-FLIGHT DE LLAMADAS A N8N ---
+# Si llegan a la vez varias peticiones con el mismo payload (otro usuario, un
+# doble clic), sólo la primera ejecuta el workflow; las demás esperan y
+# comparten su resultado o su error.
+class _FlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+        if not leader:
+            metric_inc(f'{self.name}_shared')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        metric_inc(f'{self.name}_executed')
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        return len(self._calls)
+
+_n8n_flights = SingleFlight('n8n_singleflight')
+
+@register_stats('n8n_singleflight')
+def _n8n_flights_stats():
+    return {'in_flight': _n8n_flights.in_flight()}
+
+# --- CACHE DE RESULTADOS DE IA ---
+# QA suele repetir exactamente los mismos conjuntos RA/AE. La clave es el hash
+# del payload canónico más la versión del workflow (N8N_WORKFLOW_VERSIONS), así
+# que publicar un workflow nuevo invalida sus entradas. `Cache-Control: no-cache`
+# fuerza una ejecución nueva. Un acierto no crea otra fila en generaciones_ia
+# para el mismo usuario; sí la crea para un usuario que aún no la tiene.
+AI_RESULT_CACHE_TTL = float(os.getenv('AI_RESULT_CACHE_TTL', '3600'))
+N8N_WORKFLOW_VERSIONS = env_map('N8N_WORKFLOW_VERSIONS')
+_ai_result_cache = TTLCache('ai_result_cache', maxsize=int(os.getenv('AI_RESULT_CACHE_SIZE', '256')), ttl=AI_RESULT_CACHE_TTL)
+
+@register_stats('ai_result_cache')
+def _ai_result_cache_stats():
+    with _metrics_lock:
+        hits, misses = _counters['ai_result_cache_hits'], _counters['ai_result_cache_misses']
+    return {'size': len(_ai_result_cache), 'maxsize': _ai_result_cache.maxsize,
+            'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None}
+
+def payload_digest(webhook, data):
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    version = N8N_WORKFLOW_VERSIONS.get(webhook, 'v1')
+    return hashlib.sha256(f"{webhook}:{version}:{canonical}".encode()).hexdigest()
+
+def cache_bypassed():
+    cache_control = request.headers.get('Cache-Control', '').lower()
+    return 'no-cache' in cache_control or 'no-store' in cache_control
+
+def _share_generation(entry, data, user_id, supabase, etiqueta):
+    if user_id not in entry['owners']:
+        entry['owners'].add(user_id)
+        save_generation(supabase, user_id, data, entry['output'], etiqueta)
+    return entry['output'], entry['status']
+
+def cached_generation(webhook, data, user_id, supabase, etiqueta):
+    entry = _ai_result_cache.get(payload_digest(webhook, data))
+    if entry is None:
+        return None
+    return _share_generation(entry, data, user_id, supabase, etiqueta)
+
+def run_generation(webhook, data, user_id, supabase, etiqueta):
+    key = payload_digest(webhook, data)
+
+    def execute():
+        output_data, status_code = call_n8n(webhook, data)
+        entry = {'output': output_data, 'status': status_code, 'owners': {user_id}}
+        _ai_result_cache.set(key, entry)
+        save_generation(supabase, user_id, data, output_data, etiqueta)
+        return entry
+
+    entry, shared = _n8n_flights.do(key, execute)
+    if not shared:
+        return entry['output'], entry['status']
+    return _share_generation(entry, data, user_id, supabase, etiqueta)
+
+def lookup_generation(webhook, data, etiqueta):
+    if cache_bypassed():
+        metric_inc('ai_result_cache_bypass')
+        return None
+    cached = cached_generation(webhook, data, g.user_id, g.supabase, etiqueta)
+    if cached is None:
+        return None
+    # Con `Prefer: respond-async` el servidor puede responder de forma síncrona
+    # (RFC 7240): un acierto se entrega directamente.
+    response = make_response(jsonify(cached[0]), cached[1])
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+# --- TRABAJOS ASÍNCRONOS DE IA ---
+# Modo opcional (`?async=1` o `Prefer: respond-async`) para las rutas que esperan
+# la cadena completa de agentes: la petición devuelve 202 con un id de trabajo y
+# la llamada a n8n corre en un pool propio, fuera de los workers de Flask. El
+# estado vive en la base SQLite local para que cualquier worker pueda servir
+# `GET /api/jobs/<id>`. Un trabajo en cola puede esperar lo que haga falta
+# mientras viva el proceso que lo aceptó; sólo se da por interrumpido si ese
+# proceso murió o si lleva 'running' más de AI_JOB_STALE_SECONDS (la llamada a
+# n8n ya habría agotado su timeout). Los estados finales no se sobrescriben.
+AI_JOB_WORKERS = int(os.getenv('AI_JOB_WORKERS', '4'))
+AI_JOB_STALE_SECONDS = float(os.getenv('AI_JOB_STALE_SECONDS', str(N8N_SYNC_TIMEOUT + 60)))
+AI_JOB_RETENTION_SECONDS = float(os.getenv('AI_JOB_RETENTION_SECONDS', '86400'))
+
+def wants_async():
+    return request.args.get('async', '').lower() in ('1', 'true') or 'respond-async' in request.headers.get('Prefer', '')
+
+class AIJobRunner:
+    def __init__(self, workers):
+        self.workers = workers
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._accepted = set()
+
+    def _executor(self):
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ai-job')
+                    self._accepted = set()
+                    self._pid = os.getpid()
+        return self._pool
+
+    def submit(self, kind, webhook, data, user_id, etiqueta):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        conn = state_db()
+        conn.execute('DELETE FROM ai_jobs WHERE updated_at < ?', (now - AI_JOB_RETENTION_SECONDS,))
+        executor = self._executor()
+        conn.execute('INSERT INTO ai_jobs (id, user_id, kind, status, owner_pid, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (job_id, user_id, kind, 'queued', os.getpid(), now, now))
+        metric_inc('ai_jobs_submitted')
+        self._accepted.add(job_id)
+        executor.submit(self._run_traced, current_trace(), job_id, webhook, data, user_id, etiqueta)
+        return job_id
+
+    def _update(self, job_id, status, result=None, http_status=None, from_status=('queued', 'running')):
+        # Devuelve False si el trabajo ya no estaba en `from_status` (p. ej. se dio por interrumpido).
+        return state_db().execute(
+            f"UPDATE ai_jobs SET status = ?, result = ?, http_status = ?, updated_at = ? WHERE id = ? AND status IN ({','.join('?' * len(from_status))})",
+            (status, json.dumps(result) if result is not None else None, http_status, time.time(), job_id, *from_status)).rowcount > 0
+
+    def _run_traced(self, trace, job_id, webhook, data, user_id, etiqueta):
+        try:
+            with trace_context(*trace):
+                self._run(job_id, webhook, data, user_id, etiqueta)
+        finally:
+            self._accepted.discard(job_id)
+
+    def _run(self, job_id, webhook, data, user_id, etiqueta):
+        if not self._update(job_id, 'running', from_status=('queued',)):
+            return
+        try:
+            output_data, status_code = run_generation(webhook, data, user_id, get_supabase(), etiqueta)
+        except CircuitOpenError as e:
+            self._update(job_id, 'error', circuit_open_body(e), 503)
+            metric_inc('ai_jobs_failed')
+            return
+        except requests.exceptions.RequestException as e:
+            body, status_code = n8n_error_response(e, webhook)
+            self._update(job_id, 'error', body, status_code)
+            metric_inc('ai_jobs_failed')
+            return
+        except Exception as e:
+            app.logger.error(f"Error en trabajo asíncrono {job_id}: {str(e)}")
+            self._update(job_id, 'error', {'error': 'Error inesperado al procesar la solicitud.'}, 500)
+            metric_inc('ai_jobs_failed')
+            return
+        if self._update(job_id, 'done', output_data, status_code):
+            metric_inc('ai_jobs_completed')
+
+    def _interrupted(self, job):
+        owner = job['owner_pid']
+        if job['status'] == 'running' and job['updated_at'] < time.time() - AI_JOB_STALE_SECONDS:
+            return True
+        if owner is None:
+            return job['updated_at'] < time.time() - AI_JOB_STALE_SECONDS  # filas anteriores a owner_pid
+        if owner == os.getpid():
+            return job['id'] not in self._accepted  # el PID lo reutiliza un proceso nuevo
+        return not _pid_alive(owner)
+
+    def get(self, job_id, user_id):
+        row = state_db().execute('SELECT * FROM ai_jobs WHERE id = ? AND user_id = ?', (job_id, user_id)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        if job['status'] in ('queued', 'running') and self._interrupted(job):
+            result = {'error': 'El trabajo fue interrumpido antes de completarse.'}
+            if self._update(job_id, 'error', result, 504, from_status=(job['status'],)):
+                job.update(status='error', http_status=504, result=json.dumps(result))
+                metric_inc('ai_jobs_interrupted')
+            else:
+                return self.get(job_id, user_id)  # terminó entretanto
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def pending(self):
+        return self._pool._work_queue.qsize() if self._pid == os.getpid() else 0
+
+_ai_jobs = AIJobRunner(AI_JOB_WORKERS)
+
+@register_stats('ai_jobs')
+def _ai_jobs_stats():
+    return {'queued_in_process': _ai_jobs.pending(), 'workers_per_process': _ai_jobs.workers}
+
+def accepted_job_response(job_id):
+    response = make_response(jsonify({
+        'job_id': job_id, 'status': 'queued',
+        'status_url': f'/api/jobs/{job_id}', 'events_url': f'/api/jobs/{job_id}/events',
+    }), 202)
+    response.headers['Location'] = f'/api/jobs/{job_id}'
+    return response
+
+# --- GET CONDICIONAL (ETAG) ---
+# El frontend vuelve a pedir los listados tras cada evento realtime. n8n escribe
+# directo en Supabase, así que la versión sale de la base: un trigger mantiene
+# `updated_at` en cada fila (supabase/migrations/20261019000000_updated_at.sql)
+# y el ETag débil es un digest de los pares id/updated_at que formarían la
+# respuesta, leídos con un select ligero. Si coincide con `If-None-Match` se
+# responde 304 sin leer ni serializar las filas completas. Mientras falte la
+# columna, el ETag es un digest del cuerpo ya leído. Para medir el ahorro se
+# recuerda lo que costó la última respuesta completa por ETag (lectura y
+# serialización, o sólo serialización con el digest del cuerpo) y se descuenta
+# lo que cuesta calcular el ETag en cada petición.
+_etag_sizes = TTLCache('etag_sizes', maxsize=4096, ttl=3600)
+_updated_at_column = {'available': True}
+
+@register_stats('conditional_get')
+def _conditional_get_stats():
+    with _metrics_lock:
+        not_modified = _counters['etag_not_modified']
+        bytes_saved = _counters['etag_bytes_saved']
+        avoided_ms = _counters['etag_work_us_avoided'] / 1000
+        check_ms = _counters['etag_check_us'] / 1000
+    return {
+        'not_modified': not_modified,
+        'bytes_saved': bytes_saved,
+        'work_ms_avoided': round(avoided_ms, 3),
+        'etag_check_ms': round(check_ms, 3),
+        'net_ms_saved': round(avoided_ms - check_ms, 3),
+        'avg_bytes_saved_per_304': round(bytes_saved / not_modified) if not_modified else None,
+        'versioned': _updated_at_column['available'],
+    }
+
+def not_modified_response(etag):
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    metric_inc('etag_not_modified')
+    saved = _etag_sizes.get(etag)
+    if saved:
+        metric_inc('etag_bytes_saved', saved[0])
+        metric_inc('etag_work_us_avoided', saved[1])
+    return response
+
+def etag_precheck(version_query):
+    # `version_query` selecciona sólo id/updated_at de las filas de la respuesta.
+    # Devuelve (304 o None, etag); etag None si la columna aún no existe.
+    if not _updated_at_column['available']:
+        return None, None
+    started = time.perf_counter()
+    try:
+        rows = version_query.execute().data
+    except Exception as e:
+        if 'updated_at' not in str(e):
+            raise
+        app.logger.warning("La columna updated_at no existe; los ETag se calculan sobre el cuerpo. "
+                           "Aplica supabase/migrations/20261019000000_updated_at.sql.")
+        _updated_at_column['available'] = False
+        return None, None
+    etag = hashlib.blake2b(repr((request.full_path, rows)).encode(), digest_size=16).hexdigest()
+    metric_inc('etag_check_us', int((time.perf_counter() - started) * 1_000_000))
+    if request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag), etag
+    g.etag_work_started = time.perf_counter()
+    return None, etag
+
+def conditional_json(data, etag=None):
+    if etag is None:
+        started = time.perf_counter()
+        etag = hashlib.blake2b(repr(data).encode(), digest_size=16).hexdigest()
+        metric_inc('etag_check_us', int((time.perf_counter() - started) * 1_000_000))
+        if request.if_none_match.contains_weak(etag):
+            return not_modified_response(etag)
+        work_started = time.perf_counter()
+    else:
+        work_started = g.pop('etag_work_started', time.perf_counter())
+
+    response = make_response(jsonify(data))
+    _etag_sizes.set(etag, (response.content_length or 0, int((time.perf_counter() - work_started) * 1_000_000)))
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# --- DEDUPLICACIÓN DE DIs POR CONTENIDO ---
+# Cada DI guarda el SHA-256 de su archivo. Si el mismo usuario ya ingirió ese
+# contenido con la misma estructura MEI, el DI nuevo copia el resultado de la
+# ingesta y no se dispara el webhook `ingesta-di`. La columna `hash_contenido`
+# la crea supabase/migrations/20261018000000_hash_contenido.sql; mientras no
+# exista, los DIs se guardan sin hash y la deduplicación queda desactivada.
+# El flujo de ingesta marca los archivos que no son DIs escribiendo el texto
+# 'null' en contenido_html, así que ese valor no cuenta como contenido ingerido.
+INGESTA_REUSED_COLUMNS = ('contenido_html',)
+_content_hash_column = {'available': True}
+
+def find_ingested_duplicates(supabase, user_id, content_hashes, estructura_mei):
+    # Una sola consulta para todos los hashes; devuelve {hash: fila reutilizable}.
+    if not _content_hash_column['available']:
+        return {}
+    try:
+        query = supabase.table('disenos_instruccionales').select('id_di, hash_contenido, ' + ', '.join(INGESTA_REUSED_COLUMNS)) \
+            .eq('id_usuario', user_id).in_('hash_contenido', list(set(content_hashes))).eq('estructura_mei', estructura_mei)
+        for column in INGESTA_REUSED_COLUMNS:
+            query = query.not_.is_(column, 'null').neq(column, 'null').neq(column, '')
+        result = query.execute()
+    except Exception as e:
+        app.logger.warning(f"No se pudo buscar DIs duplicados: {str(e)}")
+        return {}
+    duplicates = {row['hash_contenido']: row for row in result.data}
+    metric_inc('di_dedup_hits', sum(1 for content_hash in content_hashes if content_hash in duplicates))
+    metric_inc('di_dedup_misses', sum(1 for content_hash in content_hashes if content_hash not in duplicates))
+    return duplicates
+
+def ingesta_inicial(duplicate):
+    if duplicate:
+        return proceso_estado('ingesta', 'success', reutilizado_de=duplicate['id_di'])
+    return proceso_estado('ingesta', 'processing')
+
+# --- ALTA MASIVA ---
+BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', '50'))
+BATCH_UPLOAD_WORKERS = int(os.getenv('BATCH_UPLOAD_WORKERS', '4'))
+
+# --- PAGINACIÓN POR KEYSET ---
+# El cursor codifica (created_at, id) de la última fila entregada; la página
+# siguiente pide las filas estrictamente anteriores en orden descendente, sin
+# OFFSET, así que su costo no crece con el número de páginas.
+DI_LIST_COLUMNS = 'id_di, id_usuario, nombre_archivo, estructura_mei, proceso_actual, created_at'
+PAGE_DEFAULT_LIMIT = 50
+PAGE_MAX_LIMIT = 200
+
+GENERATION_FIELDS = ('id', 'user_id', 'nombre_generacion', 'created_at', 'input_data', 'output_data')
+# El listado del panel sólo necesita la estructura MEI y saber si es una
+# revisión (sus indicadores traen verbo_observable); el resto de input_data y
+# output_data se pide al abrir la generación (GET /api/generations/<id>).
+GENERATION_SUMMARY_COLUMNS = (
+    'id, user_id, nombre_generacion, created_at, estructura_mei:input_data->>estructuraMEI, '
+    'verbo_ra:output_data->analisisResultadosAprendizaje->0->indicadoresGenerados->0->>verbo_observable, '
+    'verbo_ae:output_data->analisisAprendizajesEsperados->0->indicadoresGenerados->0->>verbo_observable')
+
+def generation_summary(row):
+    verbo_ra, verbo_ae = row.pop('verbo_ra', None), row.pop('verbo_ae', None)
+    return {**row, 'es_revision': bool(verbo_ra or verbo_ae)}
+
+def generation_columns(fields):
+    if not fields:
+        return GENERATION_SUMMARY_COLUMNS
+    requested = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in requested if field not in GENERATION_FIELDS]
+    if unknown:
+        raise ValueError(f"Campos desconocidos: {', '.join(unknown)}")
+    # `id` y `created_at` siempre viajan: el cursor se construye con ellos.
+    columns = ['id', 'created_at'] + [field for field in requested if field not in ('id', 'created_at')]
+    return ', '.join(columns)
+
+def encode_cursor(created_at, row_id):
+    return base64.urlsafe_b64encode(json.dumps([created_at, row_id]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    # El cursor llega del cliente y sus valores acaban dentro del filtro `or`
+    # de PostgREST: sólo se aceptan una fecha ISO y un UUID.
     try:
-        result = g.supabase.table('disenos_instruccionales').select('id_usuario, nombre_archivo').eq('id_di', str(di_id)).single().execute()
-        return result.data if result.data and result.data['id_usuario'] == g.user_id else None
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        datetime.fromisoformat(created_at)
+        return created_at, str(uuid.UUID(row_id))
     except Exception:
+        raise ValueError('Cursor inválido.')
+
+def page_params():
+    try:
+        limit = int(request.args.get('limit', PAGE_DEFAULT_LIMIT))
+    except ValueError:
+        raise ValueError('El parámetro limit debe ser un entero.')
+    if not 1 <= limit <= PAGE_MAX_LIMIT:
+        raise ValueError(f'El parámetro limit debe estar entre 1 y {PAGE_MAX_LIMIT}.')
+    cursor = request.args.get('cursor')
+    return limit, decode_cursor(cursor) if cursor else None
+
+def keyset_page(query, cursor, id_column, limit):
+    if cursor:
+        created_at, row_id = cursor
+        query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",{id_column}.lt."{row_id}")')
+    # Pedimos una fila extra para saber si hay página siguiente.
+    return query.order('created_at', desc=True).order(id_column, desc=True).limit(limit + 1)
+
+def page_body(rows, id_column, limit):
+    items = rows[:limit]
+    next_cursor = encode_cursor(items[-1]['created_at'], items[-1][id_column]) if len(rows) > limit else None
+    return {'items': items, 'next_cursor': next_cursor}
+
+# --- ESTADO DE PROCESOS DE DI (proceso_actual) ---
+# Punto único para las transiciones de `proceso_actual`: cada escritura lleva
+# marca de tiempo, devuelve la representación de las filas en la misma llamada
+# y notifica por broadcast. Varias filas se actualizan en una sola sentencia.
+def proceso_estado(nombre, estado, **detalle):
+    return {"nombre": nombre, "estado": estado, **detalle, "timestamp": datetime.now(timezone.utc).isoformat()}
+
+PROCESS_STALE_SECONDS = int(os.getenv('PROCESS_STALE_SECONDS', 900))
+
+def proceso_libre_filter():
+    # Un DI admite un proceso nuevo si no tiene ninguno en curso o si el que
+    # figura lleva más de PROCESS_STALE_SECONDS sin moverse (worker caído).
+    # Los estados sin marca de tiempo son anteriores a este control.
+    stale = datetime.fromtimestamp(time.time() - PROCESS_STALE_SECONDS, timezone.utc).isoformat()
+    return ('proceso_actual.is.null,proceso_actual->>estado.is.null,proceso_actual->>estado.neq.processing,'
+            f'proceso_actual->>timestamp.is.null,proceso_actual->>timestamp.lt."{stale}"')
+
+def set_proceso(supabase, di_ids, nombre, estado, extra_fields=None, only_if_idle=False, if_timestamp=None, if_untimed=False, **detalle):
+    di_ids = [str(di_id) for di_id in (di_ids if isinstance(di_ids, (list, tuple, set)) else [di_ids])]
+    query = supabase.table('disenos_instruccionales').update({'proceso_actual': proceso_estado(nombre, estado, **detalle), **(extra_fields or {})})
+    query = query.eq('id_di', di_ids[0]) if len(di_ids) == 1 else query.in_('id_di', di_ids)
+    if only_if_idle:
+        query = query.or_(proceso_libre_filter())
+    if if_timestamp:
+        # Compare-and-set: sólo si nadie ha vuelto a escribir el proceso desde que se leyó.
+        query = query.eq('proceso_actual->>timestamp', if_timestamp)
+    elif if_untimed:
+        query = query.is_('proceso_actual->>timestamp', 'null')
+    updated = query.execute().data or []
+    for updated_di in updated:
+        broadcast_change("UPDATE", new_data=updated_di)
+    if updated and estado != 'processing':
+        _outbox.release([updated_di['id_di'] for updated_di in updated])
+    return updated
+
+def start_proceso(supabase, di_ids, nombre, extra_fields=None):
+    # Update condicional atómico: solo pasan a 'processing' los DIs libres.
+    # Los que falten en el resultado ya tienen un proceso en curso (o no existen).
+    updated = set_proceso(supabase, di_ids, nombre, 'processing', extra_fields=extra_fields, only_if_idle=True)
+    metric_inc('proceso_started', len(updated))
+    return updated
+
+def mark_proceso_error(supabase, di_ids, nombre, error_detalle):
+    return set_proceso(supabase, di_ids, nombre, 'error', error_detalle=error_detalle)
+
+def procesos_actuales(supabase, di_ids):
+    rows = supabase.table('disenos_instruccionales').select('id_di, proceso_actual').in_('id_di', [str(di_id) for di_id in di_ids]).execute().data
+    return {str(row['id_di']): row['proceso_actual'] for row in rows}
+
+def proceso_started_at(proceso):
+    try:
+        return datetime.fromisoformat(proceso['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time() - PROCESS_STALE_SECONDS
+
+def proceso_en_curso_response(supabase, di_id):
+    actuales = procesos_actuales(supabase, [di_id])
+    if str(di_id) not in actuales: return jsonify({'message': 'DI no encontrado.'}), 404
+    metric_inc('proceso_rejected_busy')
+    return jsonify({'message': 'Ya hay un proceso en curso para este DI.', 'proceso_actual': actuales[str(di_id)],
+                    'job': _outbox.active_job(di_id)}), 409
+
+def insert_dis(supabase, records, procesos):
+    # El estado inicial viaja dentro del insert: una sola ida y vuelta que
+    # devuelve las filas completas, listas para el broadcast.
+    rows = [{**record, 'proceso_actual': proceso} for record, proceso in zip(records, procesos)]
+    if not _content_hash_column['available']:
+        rows = [{k: v for k, v in row.items() if k != 'hash_contenido'} for row in rows]
+    try:
+        created = supabase.table('disenos_instruccionales').insert(rows).execute().data
+    except Exception as e:
+        if 'hash_contenido' not in str(e) or not any('hash_contenido' in row for row in rows):
+            raise
+        app.logger.warning("La columna hash_contenido no existe; se desactiva la deduplicación. "
+                           "Aplica supabase/migrations/20261018000000_hash_contenido.sql.")
+        _content_hash_column['available'] = False
+        return insert_dis(supabase, records, procesos)
+    for created_di in created:
+        broadcast_change("INSERT", new_data=created_di)
+    return created
+
+# --- PAYLOADS DE PROCESOS DE DI ---
+ALIGNMENT_TERMS = {
+    'MEI-Antiguo': (
+        "resultadoAprendizaje, aprendizajeEsperado, indicadorDeLogro",
+        "Definición de Aprendizaje Esperado, Indicador de Logro, y todos los verbos de la taxonomía UNAB",
+    ),
+    'MEI-Actualizado': (
+        "resultadoFormativo, resultadoAprendizaje, indicadorDesempeno",
+        "Definición de Resultado Formativo, Resultado de Aprendizaje, Indicador de Desempeño, y todos los verbos de la taxonomía UNAB",
+    ),
+}
+
+def alignment_payload(di_id, estructura_mei):
+    if estructura_mei not in ALIGNMENT_TERMS:
         return None
+    terminos_vocabulario, terminos_dominio = ALIGNMENT_TERMS[estructura_mei]
+    return { "di_id": str(di_id), "estructuraMEI": estructura_mei, "terminosVocabulario": terminos_vocabulario, "terminosDominio": terminos_dominio }
+
+# --- DISPAROS MASIVOS ---
+# Re-validar o re-analizar un programa completo: propiedad verificada con una
+# sola consulta `in_`, un único update de `proceso_actual` para todas las filas
+# y las ejecuciones de n8n encoladas en el grupo 'batch' del outbox, con su
+# propio tope de concurrencia (BATCH_TRIGGER_CONCURRENCY).
+BATCH_MAX_DIS = int(os.getenv('BATCH_MAX_DIS', '200'))
+
+def batch_di_ids():
+    data = request.get_json(silent=True) or {}
+    di_ids = data.get('di_ids')
+    if not isinstance(di_ids, list) or not di_ids:
+        raise ValueError('Se requiere una lista di_ids no vacía.')
+    if len(di_ids) > BATCH_MAX_DIS:
+        raise ValueError(f'Se admiten como máximo {BATCH_MAX_DIS} DIs por lote.')
+    try:
+        return list(dict.fromkeys(str(uuid.UUID(str(di_id))) for di_id in di_ids))
+    except ValueError:
+        raise ValueError('di_ids contiene identificadores inválidos.')
+
+def check_dis_ownership(di_ids):
+    result = g.supabase.table('disenos_instruccionales').select('id_di, ' + ', '.join(DI_META_COLUMNS)) \
+        .in_('id_di', di_ids).eq('id_usuario', g.user_id).execute()
+    owned = {}
+    for row in result.data:
+        owned[str(row['id_di'])] = row
+        _di_meta_cache.set(str(row['id_di']), {column: row[column] for column in DI_META_COLUMNS})
+    return owned
+
+def trigger_di_batch(proceso_nombre, webhook, build_payload, extra_fields=None):
+    try:
+        di_ids = batch_di_ids()
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    owned = check_dis_ownership(di_ids)
+    rejected = [{'di_id': di_id, 'message': 'Acción no autorizada.'} for di_id in di_ids if di_id not in owned]
+    payloads = {}
+    for di_id, di_info in owned.items():
+        payload = build_payload(di_id, di_info)
+        if payload is None:
+            rejected.append({'di_id': di_id, 'message': f"Estructura MEI desconocida: {di_info['estructura_mei']}"})
+        else:
+            payloads[di_id] = payload
+    if not payloads:
+        return jsonify({'message': 'Ningún DI del lote puede procesarse.', 'rejected': rejected}), 403
+    limited = rate_limit_response('batch', cost=len(payloads))
+    if limited: return limited
+
+    started = []
+    try:
+        started = [str(row['id_di']) for row in start_proceso(g.supabase, list(payloads), proceso_nombre, extra_fields=extra_fields)]
+        busy = [di_id for di_id in payloads if di_id not in started]
+        if busy:
+            refund_rate_limit(len(busy))
+            actuales = procesos_actuales(g.supabase, busy)
+            rejected.extend({'di_id': di_id, 'message': 'Ya hay un proceso en curso para este DI.', 'proceso_actual': actuales.get(di_id)} for di_id in busy)
+        if not started:
+            return jsonify({'message': 'Ningún DI del lote puede procesarse.', 'rejected': rejected}), 409
+        for di_id in started:
+            enqueue_webhook(webhook, payloads[di_id], di_id=di_id, proceso=proceso_nombre, concurrency_group='batch')
+        return jsonify({'message': f'Se programaron {len(started)} DIs.', 'scheduled': started, 'rejected': rejected}), 202
+    except Exception as e:
+        app.logger.error(f"Error al iniciar el lote de {proceso_nombre}: {str(e)}")
+        if started: mark_proceso_error(g.supabase, started, proceso_nombre, "No se pudo iniciar el proceso.")
+        return jsonify({'message': f'No se pudo iniciar el lote: {str(e)}'}), 500
+
+# --- REAPER DE PROCESOS ATASCADOS ---
+# Si n8n muere a mitad de un flujo nadie vuelve a escribir `proceso_actual` y el
+# DI queda en 'processing'. Un hilo por worker revisa cada REAPER_INTERVAL los
+# procesos que superaron su plazo; una concesión en la base local hace que sólo
+# uno de los workers barra en cada ciclo. Cada reintento vuelve a encolar el
+# webhook original (o lo reconstruye) y suma 'reintentos' en el propio
+# proceso; agotados REAPER_MAX_ATTEMPTS, el DI pasa a 'error'. Todas las
+# escrituras son compare-and-set sobre el timestamp leído.
+REAPER_INTERVAL = float(os.getenv('REAPER_INTERVAL', '60'))
+REAPER_MAX_ATTEMPTS = int(os.getenv('REAPER_MAX_ATTEMPTS', '2'))
+REAPER_BATCH = int(os.getenv('REAPER_BATCH', '100'))
+PROCESS_DEADLINES = {'ingesta': 600, 'evaluacion': 600, 'consulta': 300, 'analisis_alineamiento': 900, **env_map('PROCESS_DEADLINES', int)}
+PROCESS_WEBHOOKS = {'ingesta': 'ingesta-di', 'evaluacion': 'validar-di', 'consulta': 'interaccion-ia', 'analisis_alineamiento': 'analyze-alignment'}
+
+def acquire_lease(name, seconds):
+    now = time.time()
+    return state_db().execute(
+        "INSERT INTO scheduler_leases (name, holder, lease_until) VALUES (?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, lease_until = excluded.lease_until "
+        "WHERE scheduler_leases.lease_until < ? OR scheduler_leases.holder = excluded.holder",
+        (name, str(os.getpid()), now + seconds, now)).rowcount > 0
+
+def rebuild_process_payload(nombre, di_id, estructura_mei):
+    if nombre == 'ingesta':
+        payload = {"di_id": di_id, "estructuraMEI": estructura_mei}
+    elif nombre == 'evaluacion':
+        payload = {'di_id': di_id}
+    elif nombre == 'analisis_alineamiento':
+        payload = alignment_payload(di_id, estructura_mei)
+    else:
+        payload = None  # la consulta depende del prompt original
+    return (PROCESS_WEBHOOKS[nombre], payload) if payload else None
+
+class ProcessReaper:
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_run = None
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() or self.interval <= 0:
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='process-reaper', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if acquire_lease('process-reaper', self.interval):
+                    self.scan()
+            except Exception as e:
+                app.logger.error(f"Error en el reaper de procesos: {str(e)}")
+
+    def scan(self):
+        supabase = get_supabase()
+        now = time.time()
+        cutoff = datetime.fromtimestamp(now - min(PROCESS_DEADLINES.values()), timezone.utc).isoformat()
+        rows = supabase.table('disenos_instruccionales').select('id_di, estructura_mei, proceso_actual') \
+            .eq('proceso_actual->>estado', 'processing') \
+            .or_(f'proceso_actual->>timestamp.is.null,proceso_actual->>timestamp.lt."{cutoff}"') \
+            .limit(REAPER_BATCH).execute().data
+        self.last_run = now
+        metric_inc('reaper_scans')
+        for row in rows:
+            proceso = row['proceso_actual']
+            if not proceso.get('timestamp'):
+                # Estado anterior a las marcas de tiempo: un DI abandonado hace
+                # tiempo. Se cierra sin reintentar para no relanzar flujos viejos.
+                if set_proceso(supabase, row['id_di'], proceso.get('nombre'), 'error', if_untimed=True,
+                               error_detalle="El proceso quedó interrumpido."):
+                    metric_inc('reaper_abandoned')
+                continue
+            if now - proceso_started_at(proceso) < PROCESS_DEADLINES.get(proceso.get('nombre'), PROCESS_STALE_SECONDS):
+                continue
+            if _outbox.active_job(row['id_di']):
+                metric_inc('reaper_skipped_in_outbox')  # el outbox sigue reintentando la entrega
+                continue
+            try:
+                self._reap(supabase, row)
+            except Exception as e:
+                app.logger.error(f"Reaper: no se pudo recuperar el DI {row['id_di']}: {str(e)}")
+
+    def _reap(self, supabase, row):
+        di_id, proceso = str(row['id_di']), row['proceso_actual']
+        nombre, attempts = proceso.get('nombre'), int(proceso.get('reintentos') or 0)
+        job = _outbox.last_job(di_id, nombre)
+        webhook = job['webhook'] if job else PROCESS_WEBHOOKS.get(nombre)
+        for execution_id in [job['execution_id']] if job and job['execution_id'] else (running_n8n_executions(di_id, webhook) or []):
+            stop_n8n_execution(execution_id)
+        if job:
+            target = (job['webhook'], json.loads(job['payload']))
+        else:
+            target = rebuild_process_payload(nombre, di_id, row['estructura_mei']) if nombre in PROCESS_WEBHOOKS else None
+
+        if target is None or attempts >= REAPER_MAX_ATTEMPTS:
+            if set_proceso(supabase, di_id, nombre, 'error', if_timestamp=proceso.get('timestamp'),
+                           error_detalle="El proceso no terminó a tiempo."):
+                metric_inc('reaper_failed')
+                app.logger.warning(f"Reaper: DI {di_id} marcado con error tras {attempts} reintentos de {nombre}.")
+            return
+        if not set_proceso(supabase, di_id, nombre, 'processing', if_timestamp=proceso.get('timestamp'), reintentos=attempts + 1):
+            return  # n8n u otro worker lo movió entretanto
+        webhook, payload = target
+        enqueue_webhook(webhook, payload, di_id=di_id, proceso=nombre, concurrency_group=job['concurrency_group'] if job else None)
+        metric_inc('reaper_requeued')
+        app.logger.warning(f"Reaper: {nombre} del DI {di_id} reencolado (reintento {attempts + 1}).")
+
+_reaper = ProcessReaper(REAPER_INTERVAL)
+
+@register_stats('reaper')
+def _reaper_stats():
+    return {'last_run': _reaper.last_run, 'interval': REAPER_INTERVAL, 'max_attempts': REAPER_MAX_ATTEMPTS, 'deadlines': PROCESS_DEADLINES}
 
 # --- RUTAS DE LA API ---
 
+@app.route('/api/admin/stats', methods=['GET'])
+@token_required
+@require_role('admin')
+def get_internal_stats():
+    with _metrics_lock:
+        counters = dict(_counters)
+    stats = {name: provider() for name, provider in _stats_providers.items()}
+    return jsonify({'pid': os.getpid(), 'counters': counters, **stats}), 200
+
+@app.route('/api/admin/outbox', methods=['GET'])
+@token_required
+@require_role('admin')
+def get_outbox_status():
+    return jsonify(_outbox.snapshot()), 200
+
+@app.route('/api/traces/spans', methods=['POST'])
+def receive_trace_spans():
+    # Callback de n8n: {"trace_id", "spans": [{"name", "start", "end", "span_id"?, "parent_id"?, "service"?, "di_id"?, "attributes"?}]}
+    if not TRACE_CALLBACK_TOKEN:
+        return jsonify({'message': 'Callback de trazas deshabilitado.'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Trace-Token', ''), TRACE_CALLBACK_TOKEN):
+        return jsonify({'message': 'Token inválido.'}), 401
+    data = request.get_json(silent=True) or {}
+    spans = data.get('spans') or ([data] if 'name' in data else [])
+    if not data.get('trace_id') or not spans or len(spans) > 100:
+        return jsonify({'message': 'Se requiere trace_id y entre 1 y 100 tramos.'}), 400
+    try:
+        rows = [(data['trace_id'], span.get('span_id') or new_span_id(), span.get('parent_id') or data.get('parent_span_id'),
+                 str(span['name']), span.get('service', 'n8n'), span.get('di_id') or data.get('di_id'),
+                 span_time(span['start']), span_time(span['end']), json.dumps(span.get('attributes') or {}))
+                for span in spans]
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'message': f'Tramo inválido: {str(e)}'}), 400
+    _write_spans(rows)
+    metric_inc('trace_spans_received', len(rows))
+    return jsonify({'received': len(rows)}), 202
+
+@app.route('/api/admin/traces', methods=['GET'])
+@token_required
+@require_role('admin')
+def list_traces():
+    di_id = request.args.get('di_id')
+    query = 'SELECT trace_id, MIN(start_time) AS started, MAX(end_time) AS ended, COUNT(*) AS spans FROM trace_spans'
+    params = ()
+    if di_id:
+        query += ' WHERE trace_id IN (SELECT trace_id FROM trace_spans WHERE di_id = ?)'
+        params = (di_id,)
+    rows = state_db().execute(query + ' GROUP BY trace_id ORDER BY started DESC LIMIT 50', params).fetchall()
+    return jsonify([{'trace_id': row['trace_id'], 'started_at': datetime.fromtimestamp(row['started'], timezone.utc).isoformat(),
+                     'duration_ms': round((row['ended'] - row['started']) * 1000, 1), 'spans': row['spans']} for row in rows]), 200
+
+@app.route('/api/admin/traces/<trace_id>', methods=['GET'])
+@token_required
+@require_role('admin')
+def get_trace(trace_id):
+    otlp = request.args.get('format') == 'otlp'
+    waterfall = trace_waterfall(trace_id)
+    if waterfall is None:
+        return jsonify({'message': 'Traza no encontrada.'}), 404
+    response = make_response(jsonify(trace_otlp(trace_id) if otlp else waterfall), 200)
+    if request.args.get('download'):
+        response.headers['Content-Disposition'] = f'attachment; filename="{trace_id}.{"otlp.json" if otlp else "json"}"'
+    return response
+
+@app.route('/api/status/n8n', methods=['GET'])
+@token_required
+def get_n8n_status():
+    return jsonify({'pid': os.getpid(), 'webhooks': {name: breaker.snapshot() for name, breaker in list(_breakers.items())}}), 200
+
 @app.route('/api/dis', methods=['GET'])
 @token_required
 def get_all_dis():
-    result = g.supabase.table('disenos_instruccionales').select('*').eq('id_usuario', g.user_id).order('created_at', desc=True).execute()
-    return make_response(jsonify(result.data))
+    # Con `limit` o `cursor` se entra al modo listado: sólo columnas ligeras y
+    # paginación por keyset. Sin ellos se mantiene la respuesta completa.
+    def dis(columns):
+        return g.supabase.table('disenos_instruccionales').select(columns).eq('id_usuario', g.user_id)
+
+    if 'limit' not in request.args and 'cursor' not in request.args:
+        not_modified, etag = etag_precheck(dis('id_di, updated_at').order('created_at', desc=True))
+        if not_modified: return not_modified
+        result = dis('*').order('created_at', desc=True).execute()
+        return conditional_json(result.data, etag)
+
+    try:
+        limit, cursor = page_params()
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    not_modified, etag = etag_precheck(keyset_page(dis('id_di, updated_at'), cursor, 'id_di', limit))
+    if not_modified: return not_modified
+    result = keyset_page(dis(DI_LIST_COLUMNS), cursor, 'id_di', limit).execute()
+    return conditional_json(page_body(result.data, 'id_di', limit), etag)
+
+@app.route('/api/dis/<uuid:di_id>', methods=['GET'])
+@token_required
+def get_di_detail(di_id):
+    def di(columns):
+        return g.supabase.table('disenos_instruccionales').select(columns).eq('id_di', str(di_id)).eq('id_usuario', g.user_id)
+    try:
+        not_modified, etag = etag_precheck(di('id_di, updated_at'))
+        if not_modified: return not_modified
+        result = di('*').execute()
+    except Exception as e:
+        return jsonify({'message': f'Error al obtener el DI: {str(e)}'}), 500
+    if not result.data: return jsonify({'message': 'No autorizado o DI no encontrado'}), 404
+    return conditional_json(result.data[0], etag)
 
 @app.route('/api/dis', methods=['POST'])
 @token_required
@@ -106,24 +2552,18 @@ def upload_di():
     file_path = f"{g.user_id}/{file.filename}"
     
     try:
-        file_content = file.read()
-        g.supabase.storage.from_('di-bucket').upload(file=file_content, path=file_path, file_options={"content-type": file.content_type})
+        content_hash = sha256_stream(file.stream)
+        upload_to_storage(g.supabase, file.stream, file_path, file.content_type)
         
-        new_di_record = {'id_usuario': g.user_id, 'nombre_archivo': file.filename, 'estructura_mei': estructura_mei}
-        insert_result = g.supabase.table('disenos_instruccionales').insert(new_di_record).execute()
-        created_di = insert_result.data[0]
-
-        proceso_inicial = {"nombre": "ingesta", "estado": "processing"}
-        update_result = g.supabase.table('disenos_instruccionales').update({'proceso_actual': proceso_inicial}).eq('id_di', created_di['id_di']).execute()
-        di_para_broadcast = update_result.data[0]
-
-        broadcast_change("INSERT", new_data=di_para_broadcast)
+        new_di_record = {'id_usuario': g.user_id, 'nombre_archivo': file.filename, 'estructura_mei': estructura_mei, 'hash_contenido': content_hash}
+        duplicate = find_ingested_duplicates(g.supabase, g.user_id, [content_hash], estructura_mei).get(content_hash)
+        if duplicate:
+            new_di_record.update({column: duplicate[column] for column in INGESTA_REUSED_COLUMNS})
+        created_di = insert_dis(g.supabase, [new_di_record], [ingesta_inicial(duplicate)])[0]
         
-        # --- CAMBIO: Lógica de webhook dinámica ---
-        webhook_url = f"{N8N_BASE_URL.rstrip('/')}/webhook/ingesta-di"
-        payload = {"di_id": str(created_di['id_di']), "estructuraMEI": estructura_mei}
-        requests.post(webhook_url, json=payload, timeout=3)
-        # ----------------------------------------
+        if not duplicate:
+            payload = {"di_id": str(created_di['id_di']), "estructuraMEI": estructura_mei}
+            enqueue_webhook('ingesta-di', payload, di_id=created_di['id_di'], proceso='ingesta')
 
         return jsonify(created_di), 201
         
@@ -132,6 +2572,73 @@ def upload_di():
         app.logger.error(f"Error en upload_di: {str(e)}")
         return jsonify({'message': 'Error inesperado al subir el archivo.'}), 500
 
+@app.route('/api/dis/batch', methods=['POST'])
+@token_required
+def upload_di_batch():
+    # Alta masiva: las subidas a Storage corren en paralelo con un pool acotado,
+    # las filas se crean con un único insert y la ingesta se encola en el outbox,
+    # que ya limita cuántas corren a la vez en n8n.
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files: return jsonify({'message': 'No se encontraron archivos.'}), 400
+    if len(files) > BATCH_MAX_FILES: return jsonify({'message': f'Se admiten como máximo {BATCH_MAX_FILES} archivos por lote.'}), 400
+
+    estructura_mei = request.form.get('estructuraMEI')
+    if not estructura_mei: return jsonify({'message': 'La Estructura MEI es requerida.'}), 400
+
+    names = [file.filename for file in files]
+    if len(set(names)) != len(names): return jsonify({'message': 'El lote contiene nombres de archivo repetidos.'}), 400
+
+    supabase, user_id = g.supabase, g.user_id
+
+    def upload(file):
+        file_path = f"{user_id}/{file.filename}"
+        content_hash = sha256_stream(file.stream)
+        upload_to_storage(supabase, file.stream, file_path, file.content_type)
+        return file_path, content_hash
+
+    uploaded, errors = [], []
+    with ThreadPoolExecutor(max_workers=BATCH_UPLOAD_WORKERS) as pool:
+        futures = [(file, pool.submit(upload, file)) for file in files]
+        for file, future in futures:
+            try:
+                file_path, content_hash = future.result()
+                uploaded.append((file, file_path, content_hash))
+            except Exception as e:
+                if 'Duplicate' in str(e):
+                    errors.append({'nombre_archivo': file.filename, 'status': 409, 'message': f'Ya existe un archivo con el nombre "{file.filename}".'})
+                else:
+                    app.logger.error(f"Error en upload_di_batch ({file.filename}): {str(e)}")
+                    errors.append({'nombre_archivo': file.filename, 'status': 500, 'message': 'Error inesperado al subir el archivo.'})
+
+    if not uploaded:
+        return jsonify({'created': [], 'errors': errors}), max(error['status'] for error in errors)
+
+    duplicates = find_ingested_duplicates(supabase, user_id, [content_hash for _, _, content_hash in uploaded], estructura_mei)
+    new_records = []
+    for file, _, content_hash in uploaded:
+        record = {'id_usuario': user_id, 'nombre_archivo': file.filename, 'estructura_mei': estructura_mei, 'hash_contenido': content_hash}
+        duplicate = duplicates.get(content_hash)
+        if duplicate:
+            record.update({column: duplicate[column] for column in INGESTA_REUSED_COLUMNS})
+        new_records.append(record)
+
+    try:
+        # Los INSERT se notifican uno por fila; el dispatcher los agrupa en un único envío a Realtime.
+        created_dis = insert_dis(supabase, new_records, [ingesta_inicial(duplicates.get(record['hash_contenido'])) for record in new_records])
+    except Exception as e:
+        app.logger.error(f"Error en upload_di_batch al insertar: {str(e)}")
+        # Sin filas no hay DIs: se retiran los archivos para no dejar huérfanos.
+        supabase.storage.from_(STORAGE_BUCKET).remove([file_path for _, file_path, _ in uploaded])
+        if 'Duplicate' in str(e): return jsonify({'message': 'Uno o más archivos del lote ya existen.', 'errors': errors}), 409
+        return jsonify({'message': 'Error inesperado al registrar los archivos.', 'errors': errors}), 500
+
+    for created_di in created_dis:
+        if created_di['proceso_actual']['estado'] == 'processing':
+            payload = {"di_id": str(created_di['id_di']), "estructuraMEI": estructura_mei}
+            enqueue_webhook('ingesta-di', payload, di_id=created_di['id_di'], proceso='ingesta')
+
+    return jsonify({'created': created_dis, 'errors': errors}), 207 if errors else 201
+
 @app.route('/api/dis/<uuid:di_id>', methods=['DELETE'])
 @token_required
 def delete_di(di_id):
@@ -139,7 +2646,7 @@ def delete_di(di_id):
     if not di_data: return jsonify({'message': 'Acción no autorizada.'}), 404
     try:
         file_path = f"{g.user_id}/{di_data['nombre_archivo']}"
-        g.supabase.storage.from_('di-bucket').remove([file_path])
+        g.supabase.storage.from_(STORAGE_BUCKET).remove([file_path])
         g.supabase.table('disenos_instruccionales').delete().eq('id_di', str(di_id)).execute()
         broadcast_change("DELETE", old_data={'id_di': str(di_id)})
         return jsonify({'message': 'DI eliminado correctamente.'}), 200
@@ -148,58 +2655,94 @@ def delete_di(di_id):
 
 @app.route('/api/dis/<uuid:di_id>/validate', methods=['POST'])
 @token_required
+@idempotent
 def trigger_di_validation(di_id):
     if not check_di_ownership(di_id): return jsonify({'message': 'Acción no autorizada.'}), 403
+    limited = rate_limit_response('batch')
+    if limited: return limited
+    started = []
     try:
-        proceso = {"nombre": "evaluacion", "estado": "processing"}
-        update_result = g.supabase.table('disenos_instruccionales').update({'proceso_actual': proceso}).eq('id_di', str(di_id)).execute()
-        updated_di = update_result.data[0]
+        started = start_proceso(g.supabase, di_id, 'evaluacion')
+        if not started:
+            refund_rate_limit()
+            return proceso_en_curso_response(g.supabase, di_id)
         
-        broadcast_change("UPDATE", new_data=updated_di)
-        
-        # --- CAMBIO: Lógica de webhook dinámica ---
-        webhook_url = f"{N8N_BASE_URL.rstrip('/')}/webhook/validar-di"
         payload = {'di_id': str(di_id)}
-        requests.post(webhook_url, json=payload, timeout=3)
-        # ----------------------------------------
+        enqueue_webhook('validar-di', payload, di_id=di_id, proceso='evaluacion')
         
         return jsonify({'message': 'El proceso de validación ha sido iniciado.'}), 202
     except Exception as e:
-        proceso_error = {"nombre": "evaluacion", "estado": "error", "error_detalle": str(e)}
-        error_update = g.supabase.table('disenos_instruccionales').update({'proceso_actual': proceso_error}).eq('id_di', str(di_id)).execute()
-        if error_update.data:
-            broadcast_change("UPDATE", new_data=error_update.data[0])
+        if started: mark_proceso_error(g.supabase, di_id, 'evaluacion', str(e))
         return jsonify({'message': f'No se pudo iniciar la validación: {str(e)}'}), 500
     
 @app.route('/api/dis/<uuid:di_id>/interact', methods=['POST'])
 @token_required
+@idempotent
 def interact_with_di(di_id):
     if not check_di_ownership(di_id): return jsonify({'message': 'Acción no autorizada o DI no encontrado.'}), 404
 
     data = request.get_json()
     if not data or 'prompt' not in data: return jsonify({'message': 'El prompt es requerido.'}), 400
+    limited = rate_limit_response('interactive')
+    if limited: return limited
 
+    payload = { "di_id": str(di_id), "prompt": data['prompt'] }
+    dedupe_key = payload_digest('interaccion-ia', payload)
+    started = []
     try:
-        proceso = {"nombre": "consulta", "estado": "processing"}
-        update_result = g.supabase.table('disenos_instruccionales').update({'proceso_actual': proceso}).eq('id_di', str(di_id)).execute()
-        updated_di = update_result.data[0]
-        
-        broadcast_change("UPDATE", new_data=updated_di)
+        started = start_proceso(g.supabase, di_id, 'consulta')
+        if not started:
+            refund_rate_limit()
+            # La misma pregunta sobre el mismo DI se suma a la consulta en curso:
+            # su respuesta llega al DI y la ven ambos clientes.
+            shared = _outbox.shared_job(di_id, dedupe_key)
+            if shared:
+                metric_inc('consulta_shared')
+                return jsonify({'message': 'La consulta ya está en procesamiento.', 'job': shared}), 202
+            return proceso_en_curso_response(g.supabase, di_id)
 
-        # --- CAMBIO: Lógica de webhook dinámica ---
-        webhook_url = f"{N8N_BASE_URL.rstrip('/')}/webhook/interaccion-ia"
-        payload = { "di_id": str(di_id), "prompt": data['prompt'] }
-        requests.post(webhook_url, json=payload, timeout=3)
-        # ----------------------------------------
+        enqueue_webhook('interaccion-ia', payload, di_id=di_id, proceso='consulta', dedupe_key=dedupe_key)
 
         return jsonify({'message': 'La consulta ha sido enviada para procesamiento.'}), 202
     except Exception as e:
-        proceso_error = {"nombre": "consulta", "estado": "error", "error_detalle": str(e), "timestamp": datetime.now(timezone.utc).isoformat()}
-        error_update = g.supabase.table('disenos_instruccionales').update({'proceso_actual': proceso_error}).eq('id_di', str(di_id)).execute()
-        if error_update.data:
-            broadcast_change("UPDATE", new_data=error_update.data[0])
+        if started: mark_proceso_error(g.supabase, di_id, 'consulta', str(e))
         return jsonify({'message': f'No se pudo iniciar la consulta: {str(e)}'}), 500
 
+@app.route('/api/dis/<uuid:di_id>/cancel', methods=['POST'])
+@token_required
+@idempotent
+def cancel_di_process(di_id):
+    if not check_di_ownership(di_id): return jsonify({'message': 'Acción no autorizada o DI no encontrado.'}), 404
+    try:
+        proceso = procesos_actuales(g.supabase, [di_id]).get(str(di_id))
+        if not proceso or proceso.get('estado') != 'processing':
+            return jsonify({'message': 'No hay ningún proceso en curso para este DI.', 'proceso_actual': proceso}), 409
+
+        # Si el flujo ya arrancó en n8n hay que detenerlo antes de marcar el DI:
+        # de lo contrario terminaría y sobrescribiría 'cancelled'.
+        stopped = []
+        if _outbox.delivered(di_id, proceso['nombre'], proceso_started_at(proceso)):
+            running = running_n8n_executions(di_id, PROCESS_WEBHOOKS.get(proceso['nombre']))
+            if running is None:
+                return jsonify({'message': 'El proceso ya se está ejecutando en n8n y no se puede detener (API de n8n no disponible).',
+                                'proceso_actual': proceso}), 409
+            stopped = [execution_id for execution_id in running if stop_n8n_execution(execution_id)]
+            if len(stopped) < len(running):
+                return jsonify({'message': 'No se pudo detener la ejecución en n8n.', 'proceso_actual': proceso,
+                                'stopped_executions': stopped, 'unstopped_executions': [e for e in running if e not in stopped]}), 502
+        cancelled_jobs = _outbox.cancel(di_id)
+
+        updated = set_proceso(g.supabase, di_id, proceso['nombre'], 'cancelled', if_timestamp=proceso.get('timestamp'))
+        if not updated:
+            return jsonify({'message': 'El proceso terminó antes de poder cancelarlo.',
+                            'proceso_actual': procesos_actuales(g.supabase, [di_id]).get(str(di_id))}), 409
+        metric_inc('proceso_cancelled')
+        return jsonify({'message': 'Proceso cancelado.', 'proceso_actual': updated[0]['proceso_actual'], 'cancelled_jobs': cancelled_jobs,
+                        'stopped_executions': stopped}), 200
+    except Exception as e:
+        app.logger.error(f"Error al cancelar el proceso del DI {di_id}: {str(e)}")
+        return jsonify({'message': f'No se pudo cancelar el proceso: {str(e)}'}), 500
+
 @app.route('/api/dis/<uuid:di_id>/download-url', methods=['GET'])
 @token_required
 def get_download_url(di_id):
@@ -208,7 +2751,7 @@ def get_download_url(di_id):
     
     try:
         file_path = f"{g.user_id}/{di_info['nombre_archivo']}"
-        signed_url_response = g.supabase.storage.from_('di-bucket').create_signed_url(file_path, 60)
+        signed_url_response = g.supabase.storage.from_(STORAGE_BUCKET).create_signed_url(file_path, 60)
         return jsonify(signed_url_response), 200
     except Exception as e:
         return jsonify({'error': f'Error al generar URL de descarga: {e}'}), 500
@@ -216,67 +2759,63 @@ def get_download_url(di_id):
 @app.route('/api/sync/domain-glossary', methods=['POST'])
 @token_required
 @require_role('admin')
+@idempotent
 def sync_domain_glossary():
-    # --- CAMBIO: Lógica de webhook dinámica ---
-    webhook_url = f"{N8N_BASE_URL.rstrip('/')}/webhook/sincronizar-dominio"
-    requests.post(webhook_url, json={}, timeout=3)
-    # ----------------------------------------
+    enqueue_webhook('sincronizar-dominio', {})
     return jsonify({'message': 'Proceso de sincronización del glosario de dominio iniciado.'}), 202
 
 @app.route('/api/sync/vocabulary-glossary', methods=['POST'])
 @token_required
 @require_role('admin')
+@idempotent
 def sync_vocabulary_glossary():
-    # --- CAMBIO: Lógica de webhook dinámica ---
-    webhook_url = f"{N8N_BASE_URL.rstrip('/')}/webhook/sincronizar-vocabulario"
-    requests.post(webhook_url, json={}, timeout=3)
-    # ----------------------------------------
+    enqueue_webhook('sincronizar-vocabulario', {})
     return jsonify({'message': 'Proceso de sincronización del vocabulario técnico iniciado.'}), 202
 
 @app.route('/api/dis/<uuid:di_id>/analyze-alignment', methods=['POST'])
 @token_required
+@idempotent
 def trigger_alignment_analysis(di_id):
     di_info = check_di_ownership(di_id)
     if not di_info: return jsonify({'message': 'Acción no autorizada.'}), 403
+
+    estructura_mei = di_info['estructura_mei']
+    n8n_payload = alignment_payload(di_id, estructura_mei)
+    if n8n_payload is None:
+        return jsonify({'message': f'Estructura MEI desconocida: {estructura_mei}'}), 400
+    limited = rate_limit_response('batch')
+    if limited: return limited
     
+    started = []
     try:
-        di_record = g.supabase.table('disenos_instruccionales').select('estructura_mei').eq('id_di', str(di_id)).single().execute().data
-        if not di_record: return jsonify({'message': 'DI no encontrado.'}), 404
-        
-        estructura_mei = di_record['estructura_mei']
-        
-        if estructura_mei == 'MEI-Antiguo':
-            terminos_vocabulario = "resultadoAprendizaje, aprendizajeEsperado, indicadorDeLogro"
-            terminos_dominio = "Definición de Aprendizaje Esperado, Indicador de Logro, y todos los verbos de la taxonomía UNAB"
-        elif estructura_mei == 'MEI-Actualizado':
-            terminos_vocabulario = "resultadoFormativo, resultadoAprendizaje, indicadorDesempeno"
-            terminos_dominio = "Definición de Resultado Formativo, Resultado de Aprendizaje, Indicador de Desempeño, y todos los verbos de la taxonomía UNAB"
-        else:
-            return jsonify({'message': f'Estructura MEI desconocida: {estructura_mei}'}), 400
-
-        n8n_payload = { "di_id": str(di_id), "estructuraMEI": estructura_mei, "terminosVocabulario": terminos_vocabulario, "terminosDominio": terminos_dominio }
-        
-        proceso = {"nombre": "analisis_alineamiento", "estado": "processing"}
-       
-        update_result = g.supabase.table('disenos_instruccionales').update({'proceso_actual': proceso,'analisis_alineamiento': None}).eq('id_di', str(di_id)).execute()
+        started = start_proceso(g.supabase, di_id, 'analisis_alineamiento', extra_fields={'analisis_alineamiento': None})
+        if not started:
+            refund_rate_limit()
+            return proceso_en_curso_response(g.supabase, di_id)
         
-        broadcast_change("UPDATE", new_data=update_result.data[0])
-        
-        # --- CAMBIO: Lógica de webhook dinámica ---
-        webhook_url = f"{N8N_BASE_URL.rstrip('/')}/webhook/analyze-alignment"
-        requests.post(webhook_url, json=n8n_payload, timeout=3)
-        # ----------------------------------------
+        enqueue_webhook('analyze-alignment', n8n_payload, di_id=di_id, proceso='analisis_alineamiento')
         
         return jsonify({'message': 'El análisis de alineamiento ha comenzado.'}), 202
     
     except Exception as e:
         app.logger.error(f"Error al iniciar análisis de alineamiento: {str(e)}")
-        proceso_error = {"nombre": "analisis_alineamiento", "estado": "error", "error_detalle": "No se pudo iniciar el proceso."}
-        error_update = g.supabase.table('disenos_instruccionales').update({'proceso_actual': proceso_error}).eq('id_di', str(di_id)).execute()
-        if error_update.data:
-            broadcast_change("UPDATE", new_data=error_update.data[0])
+        if started: mark_proceso_error(g.supabase, di_id, 'analisis_alineamiento', "No se pudo iniciar el proceso.")
         return jsonify({'message': f'No se pudo iniciar el análisis: {str(e)}'}), 500
 
+@app.route('/api/dis/batch/validate', methods=['POST'])
+@token_required
+@idempotent
+def trigger_batch_validation():
+    return trigger_di_batch('evaluacion', 'validar-di', lambda di_id, di_info: {'di_id': di_id})
+
+@app.route('/api/dis/batch/analyze-alignment', methods=['POST'])
+@token_required
+@idempotent
+def trigger_batch_alignment_analysis():
+    return trigger_di_batch('analisis_alineamiento', 'analyze-alignment',
+                            lambda di_id, di_info: alignment_payload(di_id, di_info['estructura_mei']),
+                            extra_fields={'analisis_alineamiento': None})
+
 @app.route('/api/generate/indicators', methods=['POST'])
 @token_required
 def generate_indicators():
@@ -286,19 +2825,15 @@ def generate_indicators():
     required_fields = ['estructuraMEI']
     if not all(field in data for field in required_fields): return jsonify({"error": "Faltan campos requeridos en el payload"}), 400
 
-    # --- CAMBIO: Lógica de webhook dinámica ---
-    webhook_url = f"{N8N_BASE_URL.rstrip('/')}/webhook/generar-indicadores"
-    # ----------------------------------------
-    
-    response = requests.post(webhook_url, json=data, timeout=120) 
-    response.raise_for_status()
-        
-    output_data = response.json()
+    cached = lookup_generation('generar-indicadores', data, 'generación')
+    if cached: return cached
+    limited = rate_limit_response('interactive')
+    if limited: return limited
 
-    try:
-        g.supabase.table('generaciones_ia').insert({'user_id': g.user_id, 'input_data': data, 'output_data': output_data}).execute()
-    except Exception as e:
-        app.logger.warning(f"ADVERTENCIA: No se pudo guardar la generación en la DB: {e}")
+    if wants_async():
+        return accepted_job_response(_ai_jobs.submit('generar-indicadores', 'generar-indicadores', data, g.user_id, 'generación'))
+
+    output_data, _ = run_generation('generar-indicadores', data, g.user_id, g.supabase, 'generación')
 
     return jsonify(output_data), 200
 
@@ -311,45 +2846,122 @@ def revisar_indicadores():
     if not data:
         return jsonify({'error': 'No se proporcionaron datos'}), 400
 
-    webhook_path = "/webhook/revisar-indicadores" 
-    webhook_url = f"{N8N_BASE_URL.rstrip('/')}{webhook_path}"
+    cached = lookup_generation('revisar-indicadores', data, 'revisión')
+    if cached: return cached
+    limited = rate_limit_response('interactive')
+    if limited: return limited
 
-    headers = { 'Content-Type': 'application/json' }
+    if wants_async():
+        return accepted_job_response(_ai_jobs.submit('revisar-indicadores', 'revisar-indicadores', data, g.user_id, 'revisión'))
 
     try:
-        response = requests.post(webhook_url, json=data, headers=headers, timeout=120)
-        response.raise_for_status() 
-        
-        output_data = response.json() # Obtener el JSON de revisión
+        output_data, status_code = run_generation('revisar-indicadores', data, g.user_id, g.supabase, 'revisión')
+    except requests.exceptions.RequestException as e:
+        body, status_code = n8n_error_response(e, 'Revisar')
+        return jsonify(body), status_code
 
-        # 3. LÓGICA DE GUARDADO (Idéntica a 'generate_indicators')
-        try:
-            g.supabase.table('generaciones_ia').insert({'user_id': g.user_id, 'input_data': data, 'output_data': output_data}).execute()
-        except Exception as e:
-            app.logger.warning(f"ADVERTENCIA: No se pudo guardar la revisión en la DB: {e}")
+    return jsonify(output_data), status_code
+
+@app.route('/api/jobs/<uuid:job_id>', methods=['GET'])
+@token_required
+def get_ai_job(job_id):
+    job = _ai_jobs.get(str(job_id), g.user_id)
+    if not job: return jsonify({'message': 'Trabajo no encontrado.'}), 404
+    return jsonify({k: job[k] for k in ('id', 'kind', 'status', 'http_status', 'result', 'created_at', 'updated_at')}), 200
 
-        # 4. Devolver la respuesta de n8n al frontend
-        return jsonify(output_data), response.status_code
+@app.route('/api/jobs/<uuid:job_id>/events', methods=['GET'])
+@token_required
+def stream_ai_job(job_id):
+    job_id, user_id = str(job_id), g.user_id
+    if not _ai_jobs.get(job_id, user_id): return jsonify({'message': 'Trabajo no encontrado.'}), 404
+
+    def events():
+        last_status = None
+        deadline = time.time() + AI_JOB_STALE_SECONDS
+        while time.time() < deadline:
+            job = _ai_jobs.get(job_id, user_id)
+            if job['status'] != last_status:
+                last_status = job['status']
+                event = 'result' if last_status in ('done', 'error') else 'status'
+                yield f"event: {event}\ndata: {json.dumps({'status': last_status, 'http_status': job['http_status'], 'result': job['result']})}\n\n"
+                if event == 'result':
+                    return
+            else:
+                yield ": keep-alive\n\n"
+            time.sleep(1.0)
 
-    except requests.exceptions.Timeout:
-        return jsonify({"error": "La solicitud al motor de revisión tardó demasiado en responder"}), 504
-    except requests.exceptions.HTTPError as http_err:
-        app.logger.error(f"Error de n8n (Revisar): {http_err} - {response.text}")
-        return jsonify({'error': f"Error de n8n: {http_err}", 'n8n_response': response.text}), response.status_code
-    except requests.exceptions.RequestException as req_err:
-        app.logger.error(f"Error de conexión (Revisar): {req_err}")
-        return jsonify({'error': f"Error de conexión: {req_err}"}), 500
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/generations', methods=['GET'])
 @token_required
 def get_user_generations():
+    if any(param in request.args for param in ('limit', 'cursor', 'fields', 'format')):
+        return list_generations_paged()
+    def generations(columns):
+        return g.supabase.table('generaciones_ia').select(columns).eq('user_id', g.user_id).order('created_at', desc=True)
     try:
-        response = g.supabase.table('generaciones_ia').select('*').eq('user_id', g.user_id).order('created_at', desc=True).execute()
-        return jsonify(response.data), 200
+        not_modified, etag = etag_precheck(generations('id, updated_at'))
+        if not_modified: return not_modified
+        return conditional_json(generations('*').execute().data, etag)
     except Exception as e:
         app.logger.error(f"!!! ERROR en get_user_generations: {e}")
         return jsonify({"error": "Error interno al obtener las generaciones."}), 500
 
+def list_generations_paged():
+    # Por defecto sólo resúmenes; `fields=` elige columnas concretas y
+    # `format=ndjson` transmite toda la colección fila a fila en lotes.
+    try:
+        columns = generation_columns(request.args.get('fields'))
+        limit, cursor = page_params()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    supabase, user_id = g.supabase, g.user_id
+    def fetch(cursor, limit):
+        query = supabase.table('generaciones_ia').select(columns).eq('user_id', user_id)
+        rows = keyset_page(query, cursor, 'id', limit).execute().data
+        return [generation_summary(row) for row in rows] if columns == GENERATION_SUMMARY_COLUMNS else rows
+
+    if request.args.get('format') == 'ndjson':
+        def rows():
+            page_cursor = cursor
+            while True:
+                batch = fetch(page_cursor, PAGE_MAX_LIMIT)
+                for row in batch[:PAGE_MAX_LIMIT]:
+                    yield json.dumps(row, ensure_ascii=False) + '\n'
+                if len(batch) <= PAGE_MAX_LIMIT:
+                    return
+                page_cursor = (batch[PAGE_MAX_LIMIT - 1]['created_at'], batch[PAGE_MAX_LIMIT - 1]['id'])
+        return Response(stream_with_context(rows()), mimetype='application/x-ndjson')
+
+    try:
+        not_modified, etag = etag_precheck(keyset_page(
+            supabase.table('generaciones_ia').select('id, updated_at').eq('user_id', user_id), cursor, 'id', limit))
+        if not_modified: return not_modified
+        return conditional_json(page_body(fetch(cursor, limit), 'id', limit), etag)
+    except Exception as e:
+        app.logger.error(f"!!! ERROR en get_user_generations: {e}")
+        return jsonify({"error": "Error interno al obtener las generaciones."}), 500
+
+@app.route('/api/generations/<uuid:generation_id>', methods=['GET'])
+@token_required
+def get_user_generation(generation_id):
+    def generation(columns):
+        return g.supabase.table('generaciones_ia').select(columns).match({'id': str(generation_id), 'user_id': g.user_id})
+    try:
+        not_modified, etag = etag_precheck(generation('id, updated_at'))
+        if not_modified: return not_modified
+        response = generation('*').execute()
+    except Exception as e:
+        app.logger.error(f"!!! ERROR en get_user_generation: {e}")
+        return jsonify({"error": "Error interno al obtener la generación."}), 500
+    if not response.data:
+        return jsonify({"error": "Generación no encontrada"}), 404
+    return conditional_json(response.data[0], etag)
+
 @app.route('/api/generations/<uuid:generation_id>', methods=['DELETE'])
 @token_required
 def delete_user_generation(generation_id):
@@ -387,9 +2999,11 @@ def get_di_validation_results(di_id):
     # para que coincida con apiService.js
     if not check_di_ownership(di_id): return jsonify({'message': 'Acción no autorizada.'}), 403
     try:
+        not_modified, etag = etag_precheck(g.supabase.table('disenos_instruccionales').select('id_di, updated_at').eq('id_di', str(di_id)))
+        if not_modified: return not_modified
         result = g.supabase.table('disenos_instruccionales').select('analisis_sintactico').eq('id_di', str(di_id)).single().execute()
         if result.data and result.data.get('analisis_sintactico'):
-            return jsonify(result.data['analisis_sintactico']), 200
+            return conditional_json(result.data['analisis_sintactico'], etag)
         return jsonify({'message': 'Validación no encontrada o aún en proceso.'}), 404
     except Exception as e:
         return jsonify({'message': f'Error al obtener validación: {str(e)}'}), 500
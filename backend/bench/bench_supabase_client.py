@@ -0,0 +1,130 @@
+"""Sobrecosto por petición del cliente de Supabase bajo gunicorn con varios workers.
+
+Compara el cliente compartido por worker (`get_supabase`) con construir un
+cliente nuevo en cada petición (`create_client`, el comportamiento anterior),
+sirviendo GET /api/dis con N workers de gunicorn frente a un PostgREST falso
+y C clientes concurrentes.
+
+    python backend/bench/bench_supabase_client.py --workers 4 --concurrency 16 --requests 2000
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import jwt
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+JWT_SECRET = 'bench-secret-bench-secret-bench-secret'
+SERVICE_KEY = jwt.encode({'role': 'service_role'}, JWT_SECRET, algorithm='HS256')
+
+
+def build_app():
+    # Fábrica para gunicorn: `bench_supabase_client:build_app()`.
+    sys.path.insert(0, BACKEND_DIR)
+    import app as backend
+    from supabase import create_client
+    if os.getenv('BENCH_SUPABASE_MODE') == 'per-request':
+        backend.get_supabase = lambda: create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_SERVICE_KEY'))
+    return backend.app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url, token, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, headers={'Authorization': f'Bearer {token}'}, timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('gunicorn no respondió a tiempo')
+
+
+def load(url, token, concurrency, total):
+    latencies, errors, lock = [], [0], threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        session = requests.Session()
+        headers = {'Authorization': f'Bearer {token}'}
+        for _ in iter(lambda: next(counter, None), None):
+            started = time.perf_counter()
+            try:
+                ok = session.get(url, headers=headers, timeout=30).status_code == 200
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += not ok
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def run_mode(mode, args, supabase_url):
+    port = free_port()
+    env = {**os.environ, 'BENCH_SUPABASE_MODE': mode, 'SUPABASE_URL': supabase_url, 'SUPABASE_SERVICE_KEY': SERVICE_KEY,
+           'SUPABASE_JWT_SECRET': JWT_SECRET, 'REAPER_INTERVAL': '0', 'OUTBOX_WORKERS': '0',
+           'BACKEND_STATE_DB': os.path.join(args.state_dir, f'{mode}.sqlite3'), 'METRICS_DIR': os.path.join(args.state_dir, f'metrics-{mode}')}
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--chdir', BENCH_DIR, '-w', str(args.workers), '-b', f'127.0.0.1:{port}',
+         '--log-level', 'warning', 'bench_supabase_client:build_app()'], env=env)
+    try:
+        url = f'http://127.0.0.1:{port}/api/dis'
+        token = jwt.encode({'sub': 'bench-user', 'aud': 'authenticated', 'exp': int(time.time()) + 3600}, JWT_SECRET, algorithm='HS256')
+        wait_ready(url, token)
+        load(url, token, args.concurrency, args.workers * 20)  # calentamiento: cada worker arma su cliente
+        latencies, errors, elapsed = load(url, token, args.concurrency, args.requests)
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    return {'mode': mode, 'rps': len(latencies) / elapsed, 'mean': statistics.mean(latencies) * 1000,
+            'p50': latencies[len(latencies) // 2] * 1000, 'p95': latencies[int(len(latencies) * 0.95)] * 1000, 'errors': errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='Latencia simulada del PostgREST falso.')
+    parser.add_argument('--state-dir', default=os.path.join('/tmp', 'validador_qm_bench'))
+    args = parser.parse_args()
+    os.makedirs(args.state_dir, exist_ok=True)
+
+    sys.path.insert(0, BENCH_DIR)
+    import fake_supabase
+    _, supabase_url = fake_supabase.start(latency=args.latency_ms / 1000)
+
+    print(f'gunicorn -w {args.workers}, {args.concurrency} clientes concurrentes, {args.requests} peticiones GET /api/dis')
+    print(f"{'modo':<12} {'req/s':>8} {'media ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'conexiones':>11} {'errores':>8}")
+    for mode in ('per-request', 'pooled'):
+        connections = fake_supabase.Handler.connections
+        result = run_mode(mode, args, supabase_url)
+        result['connections'] = fake_supabase.Handler.connections - connections
+        print(f"{result['mode']:<12} {result['rps']:>8.1f} {result['mean']:>9.1f} {result['p50']:>8.1f} {result['p95']:>8.1f} "
+              f"{result['connections']:>11} {result['errors']:>8}")
+
+
+if __name__ == '__main__':
+    main()
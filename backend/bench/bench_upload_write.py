@@ -0,0 +1,76 @@
+"""Latencia de POST /api/dis: insert + update de proceso_actual frente a un solo insert.
+
+Antes, upload_di insertaba la fila y luego hacía un segundo update para fijar
+`proceso_actual`; ahora el estado inicial viaja en el insert (`insert_dis`).
+El modo `insert-update` reproduce la secuencia anterior sobre el mismo código
+para medir sólo esa diferencia, contra un PostgREST falso con latencia fija.
+
+    python backend/bench/bench_upload_write.py --iterations 200 --latency-ms 20
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import jwt
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+JWT_SECRET = 'bench-secret-bench-secret-bench-secret'
+
+
+def legacy_insert_dis(backend):
+    def insert_then_update(supabase, records, procesos):
+        created = []
+        for record, proceso in zip(records, procesos):
+            row = supabase.table('disenos_instruccionales').insert(record).execute().data[0]
+            row = supabase.table('disenos_instruccionales').update({'proceso_actual': proceso}).eq('id_di', row['id_di']).execute().data[0]
+            backend.broadcast_change("INSERT", new_data=row)
+            created.append(row)
+        return created
+    return insert_then_update
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Latencia simulada por ida y vuelta a Supabase.')
+    parser.add_argument('--file-kb', type=int, default=256)
+    args = parser.parse_args()
+
+    sys.path.insert(0, BENCH_DIR)
+    import fake_supabase
+    _, supabase_url = fake_supabase.start(latency=args.latency_ms / 1000)
+    state_dir = tempfile.mkdtemp(prefix='validador_qm_bench_')
+    os.environ.update({'SUPABASE_URL': supabase_url, 'SUPABASE_SERVICE_KEY': jwt.encode({'role': 'service_role'}, JWT_SECRET, algorithm='HS256'),
+                       'SUPABASE_JWT_SECRET': JWT_SECRET, 'REAPER_INTERVAL': '0', 'OUTBOX_WORKERS': '0',
+                       'BACKEND_STATE_DB': os.path.join(state_dir, 'state.sqlite3'), 'METRICS_DIR': os.path.join(state_dir, 'metrics')})
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    import app as backend
+
+    client = backend.app.test_client()
+    token = jwt.encode({'sub': 'bench-user', 'aud': 'authenticated', 'exp': int(time.time()) + 3600}, JWT_SECRET, algorithm='HS256')
+    content = os.urandom(args.file_kb * 1024)
+    modes = {'insert-update': legacy_insert_dis(backend), 'insert': backend.insert_dis}
+
+    print(f'POST /api/dis x {args.iterations}, {args.file_kb} KB, {args.latency_ms:g} ms por ida y vuelta')
+    print(f"{'modo':<14} {'media ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'idas a PostgREST':>17}")
+    for mode, insert in modes.items():
+        backend.insert_dis = insert
+        latencies, before = [], fake_supabase.Handler.rest_requests
+        for i in range(args.iterations):
+            started = time.perf_counter()
+            response = client.post('/api/dis', headers={'Authorization': f'Bearer {token}'}, content_type='multipart/form-data',
+                                   data={'file': (io.BytesIO(content), f'{mode}-{i}.docx'), 'estructuraMEI': 'MEI-Antiguo'})
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 201, response.get_json()
+        round_trips = (fake_supabase.Handler.rest_requests - before) / args.iterations
+        latencies.sort()
+        print(f"{mode:<14} {statistics.mean(latencies) * 1000:>9.1f} {latencies[len(latencies) // 2] * 1000:>8.1f} "
+              f"{latencies[int(len(latencies) * 0.95)] * 1000:>8.1f} {round_trips:>17.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Servidor PostgREST/Storage mínimo para los benchmarks.
+
+Responde en HTTP/1.1 con keep-alive, así que un cliente que reutiliza
+conexiones se ahorra el handshake igual que frente a Supabase real. Las
+inserciones y actualizaciones devuelven el cuerpo recibido como
+representación; `latency` simula la ida y vuelta a la base.
+"""
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    requests = 0
+    rest_requests = 0
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with self.lock:
+            Handler.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        time.sleep(self.latency)
+        with self.lock:
+            Handler.requests += 1
+            Handler.rest_requests += self.path.startswith('/rest/v1/')
+        data = json.dumps(body).encode()
+        self.send_response(201 if self.command == 'POST' else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length)
+        return json.loads(data) if data and self.path.startswith('/rest/v1/') else None
+
+    def do_GET(self):
+        self._reply([])
+
+    def do_POST(self):
+        body = self._body()
+        if self.path.startswith('/rest/v1/'):
+            rows = body if isinstance(body, list) else [body]
+            self._reply([{'id_di': str(uuid.uuid4()), 'created_at': '2026-01-01T00:00:00+00:00', **row} for row in rows])
+        else:
+            self._reply({'Key': self.path})
+
+    def do_PATCH(self):
+        self._reply([{'id_di': str(uuid.uuid4()), **(self._body() or {})}])
+
+
+def start(latency=0.0, port=0):
+    Handler.latency = latency
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
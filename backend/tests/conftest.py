@@ -0,0 +1,255 @@
+import copy
+import os
+import re
+import sys
+import tempfile
+import time
+import uuid
+
+import jwt
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix='validador_qm_tests_')
+os.environ.update({
+    'SUPABASE_URL': 'http://127.0.0.1:9',
+    'SUPABASE_SERVICE_KEY': 'service-key',
+    'SUPABASE_JWT_SECRET': 'test-secret-test-secret-test-secret',
+    'BACKEND_STATE_DB': os.path.join(_TMP, 'state.sqlite3'),
+    'METRICS_DIR': os.path.join(_TMP, 'metrics'),
+    'REAPER_INTERVAL': '0',
+    'OUTBOX_WORKERS': '0',
+    'N8N_INTERNAL_URL': 'http://127.0.0.1:9/',
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+STATE_TABLES = ('outbox', 'scheduler_leases', 'rate_buckets', 'idempotency_keys', 'trace_spans', 'ai_jobs')
+
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """Subconjunto del query builder de supabase-py que usa app.py."""
+
+    def __init__(self, db, table):
+        self.db, self.table = db, table
+        self.filters, self.op, self.payload, self.columns = [], 'select', None, '*'
+        self._order, self._limit, self._single, self._negate = [], None, False, False
+
+    def select(self, columns='*', **kwargs):
+        self.columns = columns
+        return self
+
+    def insert(self, rows, **kwargs):
+        self.op, self.payload = 'insert', rows
+        return self
+
+    def update(self, values, **kwargs):
+        self.op, self.payload = 'update', values
+        return self
+
+    def delete(self, **kwargs):
+        self.op = 'delete'
+        return self
+
+    def eq(self, key, value):
+        self.filters.append(lambda row: str(field(row, key)) == str(value))
+        return self
+
+    def match(self, values):
+        for key, value in values.items():
+            self.eq(key, value)
+        return self
+
+    def neq(self, key, value):
+        self.filters.append(lambda row: str(field(row, key)) != str(value))
+        return self
+
+    def lt(self, key, value):
+        self.filters.append(lambda row: field(row, key) is not None and str(field(row, key)) < str(value))
+        return self
+
+    def in_(self, key, values):
+        values = {str(value) for value in values}
+        self.filters.append(lambda row: str(field(row, key)) in values)
+        return self
+
+    @property
+    def not_(self):
+        self._negate = True
+        return self
+
+    def is_(self, key, value):
+        negate, self._negate = self._negate, False
+        self.filters.append(lambda row: (field(row, key) is None) != negate)
+        return self
+
+    def or_(self, expression):
+        self.filters.append(lambda row: any(condition(row, part) for part in split_top(expression)))
+        return self
+
+    def order(self, key, desc=False):
+        self._order.append((key, desc))
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def single(self):
+        self._single = True
+        return self
+
+    maybe_single = single
+
+    def execute(self):
+        self.db.calls.append((self.table, self.op))
+        rows = self.db.tables.setdefault(self.table, [])
+        if self.op == 'insert':
+            created = []
+            for item in self.payload if isinstance(self.payload, list) else [self.payload]:
+                row = dict(item)
+                row.setdefault('id_di' if self.table == 'disenos_instruccionales' else 'id', str(uuid.uuid4()))
+                row.setdefault('created_at', '2026-01-%02dT00:00:00+00:00' % (len(rows) + 1))
+                rows.append(row)
+                created.append(copy.deepcopy(row))
+            return FakeResult(created)
+        matched = [row for row in rows if all(f(row) for f in self.filters)]
+        if self.op == 'update':
+            for row in matched:
+                row.update(copy.deepcopy(self.payload))
+            return FakeResult(copy.deepcopy(matched))
+        if self.op == 'delete':
+            for row in matched:
+                rows.remove(row)
+            return FakeResult(copy.deepcopy(matched))
+        for key, desc in reversed(self._order):
+            matched = sorted(matched, key=lambda row: str(row.get(key)), reverse=desc)
+        if self._limit is not None:
+            matched = matched[:self._limit]
+        if self.columns != '*':
+            columns = [column.strip() for column in self.columns.split(',')]
+            matched = [dict(project(row, column) for column in columns) for row in matched]
+        matched = copy.deepcopy(matched)
+        if self._single:
+            return FakeResult(matched[0] if matched else None)
+        return FakeResult(matched)
+
+
+def field(row, key):
+    if '->>' in key:
+        column, attribute = key.split('->>')
+        value = row.get(column)
+        return value.get(attribute) if isinstance(value, dict) else None
+    return row.get(key)
+
+
+def project(row, column):
+    # `alias:columna->clave->0->>clave`, como en los select de PostgREST.
+    alias, _, path = column.rpartition(':')
+    parts = re.split(r'->>?', path)
+    value = row.get(parts[0])
+    for part in parts[1:]:
+        if isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else None
+        else:
+            value = value.get(part) if isinstance(value, dict) else None
+    return alias or parts[-1], value
+
+
+def split_top(expression):
+    parts, depth, current = [], 0, ''
+    for char in expression:
+        if char == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+            continue
+        depth += (char == '(') - (char == ')')
+        current += char
+    return parts + [current]
+
+
+def condition(row, expression):
+    if expression.startswith('and('):
+        return all(condition(row, part) for part in split_top(expression[4:-1]))
+    key, op, value = expression.split('.', 2)
+    value, current = value.strip('"'), field(row, key)
+    if op == 'is':
+        return current is None
+    if op == 'eq':
+        return str(current) == value
+    if op == 'neq':
+        return str(current) != value
+    if op == 'lt':
+        return current is not None and str(current) < value
+    raise ValueError(expression)
+
+
+class FakeBucket:
+    def __init__(self, db):
+        self.db = db
+
+    def upload(self, file=None, path=None, file_options=None):
+        self.db.files[path] = file if isinstance(file, bytes) else file.read()
+
+    def remove(self, paths):
+        for path in paths:
+            self.db.files.pop(path, None)
+
+    def create_signed_url(self, path, expires_in):
+        return {'signedURL': f'http://storage.local/{path}'}
+
+
+class FakeStorage:
+    def __init__(self, db):
+        self.db = db
+
+    def from_(self, bucket):
+        return FakeBucket(self.db)
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.tables, self.calls, self.files = {}, [], {}
+        self.storage = FakeStorage(self)
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+def make_token(sub='user-1', role='docente'):
+    claims = {'sub': sub, 'aud': 'authenticated', 'exp': int(time.time()) + 3600, 'user_metadata': {'role': role}}
+    return jwt.encode(claims, os.environ['SUPABASE_JWT_SECRET'], algorithm='HS256')
+
+
+@pytest.fixture
+def app_mod():
+    return app_module
+
+
+@pytest.fixture
+def supabase(monkeypatch):
+    fake = FakeSupabase()
+    monkeypatch.setattr(app_module, 'get_supabase', lambda: fake)
+    monkeypatch.setattr(app_module, 'broadcast_change', lambda *args, **kwargs: None)
+    conn = app_module.state_db()
+    for table in STATE_TABLES:
+        conn.execute(f'DELETE FROM {table}')
+    app_module._di_meta_cache._data.clear()
+    return fake
+
+
+@pytest.fixture
+def client(supabase):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def auth():
+    def headers(sub='user-1', role='docente', **extra):
+        return {'Authorization': f'Bearer {make_token(sub, role)}', **extra}
+    return headers
@@ -0,0 +1,58 @@
+import json
+import os
+import time
+
+
+def insert_job(app_mod, job_id, status, owner_pid, age=0.0):
+    now = time.time() - age
+    app_mod.state_db().execute(
+        'INSERT INTO ai_jobs (id, user_id, kind, status, owner_pid, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (job_id, 'user-1', 'generar-indicadores', status, owner_pid, now, now))
+
+
+def test_queued_job_of_live_process_is_not_interrupted(app_mod, supabase):
+    insert_job(app_mod, 'job-queued', 'queued', os.getpid(), age=app_mod.AI_JOB_STALE_SECONDS * 3)
+    app_mod._ai_jobs._executor()
+    app_mod._ai_jobs._accepted.add('job-queued')
+    try:
+        assert app_mod._ai_jobs.get('job-queued', 'user-1')['status'] == 'queued'
+    finally:
+        app_mod._ai_jobs._accepted.discard('job-queued')
+
+
+def test_job_of_dead_process_is_interrupted(app_mod, supabase):
+    insert_job(app_mod, 'job-orphan', 'queued', 2 ** 22 + 12345)  # PID fuera de rango: proceso inexistente
+    job = app_mod._ai_jobs.get('job-orphan', 'user-1')
+    assert job['status'] == 'error' and job['http_status'] == 504
+
+
+def test_running_job_without_progress_is_interrupted(app_mod, supabase):
+    insert_job(app_mod, 'job-running', 'running', os.getpid(), age=app_mod.AI_JOB_STALE_SECONDS + 1)
+    app_mod._ai_jobs._accepted.add('job-running')
+    try:
+        assert app_mod._ai_jobs.get('job-running', 'user-1')['status'] == 'error'
+    finally:
+        app_mod._ai_jobs._accepted.discard('job-running')
+
+
+def test_run_does_not_overwrite_terminal_state(app_mod, supabase, monkeypatch):
+    insert_job(app_mod, 'job-done', 'error', os.getpid())
+    calls = []
+    monkeypatch.setattr(app_mod, 'run_generation', lambda *args: calls.append(args) or ({'ok': True}, 200))
+    app_mod._ai_jobs._run('job-done', 'generar-indicadores', {}, 'user-1', 'generación')
+    row = app_mod.state_db().execute('SELECT status FROM ai_jobs WHERE id = ?', ('job-done',)).fetchone()
+    assert row['status'] == 'error' and not calls
+
+
+def test_finished_run_is_not_reverted_by_late_success(app_mod, supabase, monkeypatch):
+    insert_job(app_mod, 'job-late', 'queued', os.getpid())
+
+    def slow_generation(*args):
+        # Mientras n8n responde, otro worker da el trabajo por interrumpido.
+        app_mod._ai_jobs._update('job-late', 'error', {'error': 'interrumpido'}, 504)
+        return {'ok': True}, 200
+
+    monkeypatch.setattr(app_mod, 'run_generation', slow_generation)
+    app_mod._ai_jobs._run('job-late', 'generar-indicadores', {}, 'user-1', 'generación')
+    row = app_mod.state_db().execute('SELECT status, result FROM ai_jobs WHERE id = ?', ('job-late',)).fetchone()
+    assert row['status'] == 'error' and json.loads(row['result']) == {'error': 'interrumpido'}
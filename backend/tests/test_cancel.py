@@ -0,0 +1,104 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+DI_ID = '11111111-1111-1111-1111-111111111111'
+OTHER_DI_ID = '22222222-2222-2222-2222-222222222222'
+
+
+class N8nApiHandler(BaseHTTPRequestHandler):
+    """API pública de n8n: listado de ejecuciones en curso y /stop."""
+    running = {}
+    workflows = {}
+    stopped = []
+    queries = []
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        # Forma real de una ejecución en curso sin guardar progreso: runData vacío
+        # y el body del webhook en la pila inicial.
+        query = parse_qs(urlparse(self.path).query)
+        self.queries.append(query)
+        workflow_id = query.get('workflowId', [None])[0]
+        executions = [{'id': execution_id, 'status': 'running', 'finished': False, 'workflowId': self.workflows.get(execution_id),
+                       'data': {'resultData': {'runData': {}}, 'executionData': {'nodeExecutionStack': [
+                           {'node': {'name': 'Webhook'}, 'data': {'main': [[{'json': {'headers': {}, 'body': {'di_id': di_id}}}]]}}]}}}
+                      for execution_id, di_id in self.running.items()
+                      if workflow_id is None or self.workflows.get(execution_id) == workflow_id]
+        self._reply(200, {'data': executions})
+
+    def do_POST(self):
+        execution_id = self.path.split('/')[-2]
+        self.stopped.append(execution_id)
+        self.running.pop(execution_id, None)
+        self._reply(200, {'id': execution_id, 'status': 'canceled'})
+
+
+@pytest.fixture
+def n8n_api(app_mod, monkeypatch):
+    N8nApiHandler.running, N8nApiHandler.workflows, N8nApiHandler.stopped, N8nApiHandler.queries = {}, {}, [], []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), N8nApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(app_mod, 'N8N_BASE_URL', f'http://127.0.0.1:{server.server_address[1]}/')
+    monkeypatch.setattr(app_mod, 'N8N_API_KEY', 'api-key')
+    yield N8nApiHandler
+    server.shutdown()
+
+
+@pytest.fixture
+def processing_di(app_mod, supabase):
+    proceso = app_mod.proceso_estado('analisis_alineamiento', 'processing')
+    supabase.tables['disenos_instruccionales'] = [
+        {'id_di': DI_ID, 'id_usuario': 'user-1', 'nombre_archivo': 'a.docx', 'estructura_mei': 'MEI-Antiguo', 'proceso_actual': proceso}]
+    return supabase.tables['disenos_instruccionales'][0]
+
+
+def deliver(app_mod):
+    box = app_mod._outbox
+    box._ensure_started()
+    box.enqueue('analyze-alignment', {'di_id': DI_ID}, di_id=DI_ID, proceso='analisis_alineamiento')
+    box._complete(box._claim())
+
+
+def test_cancel_stops_running_execution_found_by_di(app_mod, client, auth, n8n_api, processing_di):
+    deliver(app_mod)
+    alignment = app_mod.N8N_WORKFLOW_IDS['analyze-alignment']
+    n8n_api.running.update({'101': DI_ID, '102': OTHER_DI_ID, '103': DI_ID})
+    n8n_api.workflows.update({'101': alignment, '102': alignment, '103': app_mod.N8N_WORKFLOW_IDS['validar-di']})
+    response = client.post(f'/api/dis/{DI_ID}/cancel', headers=auth())
+    assert response.status_code == 200
+    assert response.get_json()['stopped_executions'] == ['101']
+    assert n8n_api.stopped == ['101'] and {'102', '103'} <= set(n8n_api.running)
+    assert n8n_api.queries[0]['workflowId'] == [alignment]
+    assert processing_di['proceso_actual']['estado'] == 'cancelled'
+    assert app_mod._outbox.snapshot()['running'] == 0
+
+
+def test_cancel_refuses_when_delivered_execution_cannot_be_stopped(app_mod, client, auth, processing_di, monkeypatch):
+    monkeypatch.setattr(app_mod, 'N8N_API_KEY', None)
+    deliver(app_mod)
+    response = client.post(f'/api/dis/{DI_ID}/cancel', headers=auth())
+    assert response.status_code == 409
+    assert processing_di['proceso_actual']['estado'] == 'processing'
+
+
+def test_cancel_before_delivery_only_withdraws_outbox_job(app_mod, client, auth, n8n_api, processing_di):
+    app_mod._outbox._ensure_started()
+    app_mod._outbox.enqueue('analyze-alignment', {'di_id': DI_ID}, di_id=DI_ID, proceso='analisis_alineamiento')
+    response = client.post(f'/api/dis/{DI_ID}/cancel', headers=auth())
+    assert response.status_code == 200 and response.get_json()['cancelled_jobs'] == 1
+    assert n8n_api.stopped == []
+    assert processing_di['proceso_actual']['estado'] == 'cancelled'
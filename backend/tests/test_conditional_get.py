@@ -0,0 +1,54 @@
+import pytest
+
+
+@pytest.fixture
+def dis(supabase):
+    supabase.tables['disenos_instruccionales'] = [
+        {'id_di': f'di-{i}', 'id_usuario': 'user-1', 'nombre_archivo': f'{i}.docx', 'contenido_html': '<p>x</p>' * 1000,
+         'created_at': '2026-01-0%dT00:00:00+00:00' % i, 'updated_at': '2026-01-0%dT00:00:00+00:00' % i} for i in range(1, 4)]
+    return supabase.tables['disenos_instruccionales']
+
+
+def selects(supabase):
+    return sum(1 for call in supabase.calls if call == ('disenos_instruccionales', 'select'))
+
+
+def test_versioned_etag_skips_the_full_read(app_mod, client, auth, supabase, dis, monkeypatch):
+    monkeypatch.setitem(app_mod._updated_at_column, 'available', True)
+    first = client.get('/api/dis', headers=auth())
+    assert first.status_code == 200 and first.headers['ETag']
+
+    before = selects(supabase)
+    again = client.get('/api/dis', headers=auth(**{'If-None-Match': first.headers['ETag']}))
+    assert again.status_code == 304
+    assert selects(supabase) - before == 1  # sólo id/updated_at
+
+    dis[1]['updated_at'] = '2026-02-01T00:00:00+00:00'  # escritura de n8n: el trigger mueve updated_at
+    changed = client.get('/api/dis', headers=auth(**{'If-None-Match': first.headers['ETag']}))
+    assert changed.status_code == 200 and changed.headers['ETag'] != first.headers['ETag']
+
+    stats = app_mod._conditional_get_stats()
+    assert stats['net_ms_saved'] == pytest.approx(stats['work_ms_avoided'] - stats['etag_check_ms'], abs=0.002)
+
+
+def test_body_digest_when_updated_at_is_missing(app_mod, client, auth, supabase, dis, monkeypatch):
+    monkeypatch.setitem(app_mod._updated_at_column, 'available', True)
+    table = supabase.table
+
+    def table_without_updated_at(name):
+        query = table(name)
+        execute = query.execute
+
+        def checked_execute():
+            if 'updated_at' in query.columns:
+                raise Exception('column disenos_instruccionales.updated_at does not exist')
+            return execute()
+        query.execute = checked_execute
+        return query
+    monkeypatch.setattr(supabase, 'table', table_without_updated_at)
+
+    first = client.get('/api/dis', headers=auth())
+    assert first.status_code == 200
+    assert app_mod._updated_at_column['available'] is False
+    again = client.get('/api/dis', headers=auth(**{'If-None-Match': first.headers['ETag']}))
+    assert again.status_code == 304
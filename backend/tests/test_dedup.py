@@ -0,0 +1,56 @@
+import hashlib
+import io
+
+import pytest
+
+CONTENT = b'contenido del DI'
+CONTENT_HASH = hashlib.sha256(CONTENT).hexdigest()
+
+
+def upload(client, auth, name='di.docx'):
+    return client.post('/api/dis', headers=auth(), content_type='multipart/form-data',
+                       data={'file': (io.BytesIO(CONTENT), name), 'estructuraMEI': 'MEI-Antiguo'})
+
+
+def previous_di(contenido_html):
+    return {'id_di': 'previo', 'id_usuario': 'user-1', 'estructura_mei': 'MEI-Antiguo', 'hash_contenido': CONTENT_HASH,
+            'contenido_html': contenido_html, 'proceso_actual': {'nombre': 'ingesta', 'estado': 'success'}}
+
+
+@pytest.fixture(autouse=True)
+def hash_column_available(app_mod, monkeypatch):
+    monkeypatch.setitem(app_mod._content_hash_column, 'available', True)
+
+
+def test_ingested_duplicate_is_reused(client, auth, supabase):
+    supabase.tables['disenos_instruccionales'] = [previous_di('<p>html</p>')]
+    response = upload(client, auth)
+    assert response.status_code == 201
+    created = response.get_json()
+    assert created['contenido_html'] == '<p>html</p>'
+    assert created['proceso_actual']['estado'] == 'success' and created['proceso_actual']['reutilizado_de'] == 'previo'
+
+
+@pytest.mark.parametrize('contenido_html', [None, 'null', ''])
+def test_rejected_or_empty_ingestion_is_not_reused(app_mod, client, auth, supabase, contenido_html):
+    supabase.tables['disenos_instruccionales'] = [previous_di(contenido_html)]
+    response = upload(client, auth)
+    assert response.status_code == 201
+    assert response.get_json()['proceso_actual']['estado'] == 'processing'
+    assert app_mod.state_db().execute("SELECT COUNT(*) FROM outbox WHERE webhook = 'ingesta-di'").fetchone()[0] == 1
+
+
+def test_upload_works_without_hash_column(app_mod, client, auth, supabase, monkeypatch):
+    original_execute = type(supabase.table('x')).execute
+
+    def execute(query):
+        rows = query.payload if isinstance(query.payload, list) else [query.payload]
+        if query.op == 'insert' and any('hash_contenido' in row for row in rows):
+            raise Exception("Could not find the 'hash_contenido' column of 'disenos_instruccionales' in the schema cache")
+        return original_execute(query)
+
+    monkeypatch.setattr(type(supabase.table('x')), 'execute', execute)
+    assert upload(client, auth, 'a.docx').status_code == 201
+    assert app_mod._content_hash_column['available'] is False
+    assert upload(client, auth, 'b.docx').status_code == 201
+    assert all('hash_contenido' not in row for row in supabase.tables['disenos_instruccionales'])
@@ -0,0 +1,38 @@
+import pytest
+
+
+@pytest.fixture
+def generations(supabase):
+    indicador = {'indicadoresGenerados': [{'indicador': 'Explica...'}]}
+    revisado = {'indicadoresGenerados': [{'indicador': 'Explica...', 'verbo_observable': 'explicar'}]}
+    supabase.tables['generaciones_ia'] = [
+        {'id': f'00000000-0000-0000-0000-00000000000{i}', 'user_id': 'user-1', 'nombre_generacion': name,
+         'created_at': '2026-01-0%dT00:00:00+00:00' % i,
+         'input_data': {'estructuraMEI': mei, 'resultadosAprendizaje': ['RA ' * 500]}, 'output_data': output}
+        for i, (name, mei, output) in enumerate([
+            ('gen', 'MEI-Antiguo', {'analisisAprendizajesEsperados': [indicador]}),
+            ('rev', 'MEI-Actualizado', {'analisisResultadosAprendizaje': [revisado]}),
+        ], start=1)]
+    return supabase.tables['generaciones_ia']
+
+
+def test_summary_page_has_what_the_list_renders(client, auth, generations):
+    body = client.get('/api/generations?limit=50', headers=auth()).get_json()
+    assert body['next_cursor'] is None
+    assert body['items'] == [
+        {'id': generations[1]['id'], 'user_id': 'user-1', 'nombre_generacion': 'rev', 'created_at': generations[1]['created_at'],
+         'estructura_mei': 'MEI-Actualizado', 'es_revision': True},
+        {'id': generations[0]['id'], 'user_id': 'user-1', 'nombre_generacion': 'gen', 'created_at': generations[0]['created_at'],
+         'estructura_mei': 'MEI-Antiguo', 'es_revision': False},
+    ]
+
+
+def test_explicit_fields_are_not_summarized(client, auth, generations):
+    body = client.get('/api/generations?limit=1&fields=input_data', headers=auth()).get_json()
+    assert set(body['items'][0]) == {'id', 'created_at', 'input_data'}
+
+
+def test_full_generation_is_loaded_on_demand(client, auth, generations):
+    response = client.get(f"/api/generations/{generations[0]['id']}", headers=auth())
+    assert response.status_code == 200
+    assert response.get_json()['output_data'] == generations[0]['output_data']
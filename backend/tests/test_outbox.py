@@ -0,0 +1,141 @@
+import pytest
+
+
+@pytest.fixture
+def outbox(app_mod, supabase):
+    box = app_mod._outbox
+    box._ensure_started()
+    box._last_release = 0.0
+    return box
+
+
+def processing_dis(supabase, app_mod, n, nombre='evaluacion'):
+    di_ids = [f'di-{i}' for i in range(n)]
+    supabase.tables['disenos_instruccionales'] = [
+        {'id_di': di_id, 'proceso_actual': app_mod.proceso_estado(nombre, 'processing')} for di_id in di_ids]
+    return di_ids
+
+
+def deliver_all(outbox):
+    # Reclama y entrega (sin red) todo lo que los topes permiten.
+    delivered = []
+    while (job := outbox._claim()) is not None:
+        outbox._complete(job)
+        delivered.append(job['di_id'])
+    return delivered
+
+
+def test_batch_group_slot_is_held_until_process_finishes(app_mod, supabase, outbox):
+    di_ids = processing_dis(supabase, app_mod, 5)
+    for di_id in di_ids:
+        outbox.enqueue('validar-di', {'di_id': di_id}, di_id=di_id, proceso='evaluacion', concurrency_group='batch')
+
+    first = deliver_all(outbox)
+    assert len(first) == app_mod.BATCH_TRIGGER_CONCURRENCY
+    # n8n respondió al recibir: la entrega terminó pero los flujos siguen corriendo.
+    assert deliver_all(outbox) == []
+    assert outbox.snapshot()['running'] == len(first)
+
+    outbox._release_finished()
+    assert deliver_all(outbox) == []
+
+    supabase.tables['disenos_instruccionales'][0]['proceso_actual'] = app_mod.proceso_estado('evaluacion', 'success')
+    outbox._last_release = 0.0
+    outbox._release_finished()
+    assert len(deliver_all(outbox)) == 1
+
+
+def test_backend_state_change_releases_slot_immediately(app_mod, supabase, outbox):
+    di_ids = processing_dis(supabase, app_mod, 3)
+    for di_id in di_ids:
+        outbox.enqueue('validar-di', {'di_id': di_id}, di_id=di_id, proceso='evaluacion', concurrency_group='batch')
+    first = deliver_all(outbox)
+    app_mod.mark_proceso_error(supabase, first[0], 'evaluacion', 'fallo')
+    assert deliver_all(outbox) == [di_ids[2]]
+
+
+def test_expired_process_releases_slot(app_mod, supabase, outbox, monkeypatch):
+    di_ids = processing_dis(supabase, app_mod, 3)
+    for di_id in di_ids:
+        outbox.enqueue('validar-di', {'di_id': di_id}, di_id=di_id, proceso='evaluacion', concurrency_group='batch')
+    deliver_all(outbox)
+    monkeypatch.setitem(app_mod.PROCESS_DEADLINES, 'evaluacion', -1)
+    monkeypatch.setattr(app_mod, 'get_supabase', lambda: (_ for _ in ()).throw(RuntimeError('Supabase caído')))
+    outbox._release_finished()
+    assert deliver_all(outbox) == [di_ids[2]]
+
+
+def test_jobs_without_di_free_slot_on_delivery(app_mod, supabase, outbox):
+    outbox.enqueue('sincronizar-dominio', {})
+    outbox.enqueue('sincronizar-dominio', {})
+    assert len(deliver_all(outbox)) == 2
+    assert outbox.snapshot()['running'] == 0
+
+
+def test_interactive_lane_quota_is_reachable(app_mod, supabase, outbox):
+    di_ids = processing_dis(supabase, app_mod, 6, nombre='consulta')
+    for di_id in di_ids:
+        outbox.enqueue('interaccion-ia', {'di_id': di_id, 'prompt': di_id}, di_id=di_id, proceso='consulta')
+    assert len(deliver_all(outbox)) == app_mod.OUTBOX_LANE_CONCURRENCY['interactive']
+    assert outbox.snapshot()['lanes']['interactive']['running'] == app_mod.OUTBOX_LANE_CONCURRENCY['interactive']
+
+
+def test_running_analysis_does_not_block_chat(app_mod, supabase, outbox):
+    processing_dis(supabase, app_mod, 10, nombre='analisis_alineamiento')
+    for i in range(10):
+        outbox.enqueue('analyze-alignment', {'di_id': f'di-{i}'}, di_id=f'di-{i}', proceso='analisis_alineamiento')
+    assert len(deliver_all(outbox)) == app_mod.OUTBOX_LANE_CONCURRENCY['analysis']
+    # Los análisis siguen corriendo en n8n: el carril no admite más, pero el chat sí entra.
+    supabase.tables['disenos_instruccionales'].append({'id_di': 'chat', 'proceso_actual': app_mod.proceso_estado('consulta', 'processing')})
+    outbox.enqueue('interaccion-ia', {'di_id': 'chat', 'prompt': 'hola'}, di_id='chat', proceso='consulta')
+    assert deliver_all(outbox) == ['chat']
+
+
+def test_explicit_webhook_limit_never_exceeds_its_lane(app_mod, monkeypatch):
+    monkeypatch.setitem(app_mod.OUTBOX_CONCURRENCY, 'interaccion-ia', 10)
+    assert app_mod.webhook_concurrency('interaccion-ia') == app_mod.OUTBOX_LANE_CONCURRENCY['interactive']
+    monkeypatch.setitem(app_mod.OUTBOX_CONCURRENCY, 'interaccion-ia', 1)
+    assert app_mod.webhook_concurrency('interaccion-ia') == 1
+
+
+def test_retry_queue_wait_starts_when_backoff_ends(app_mod, supabase, outbox, monkeypatch):
+    outbox.enqueue('validar-di', {'di_id': 'di-0'}, di_id='di-0', proceso='evaluacion')
+    outbox._fail(outbox._claim(), 'boom')
+    conn = app_mod.state_db()
+    conn.execute("UPDATE outbox SET next_attempt_at = next_attempt_at - ?", (app_mod.OUTBOX_BACKOFF_MAX + 1,))
+    ready_at = conn.execute('SELECT next_attempt_at FROM outbox').fetchone()[0]
+
+    job = outbox._claim()
+    monkeypatch.setattr(outbox, '_deliver', lambda job: None)
+    monkeypatch.setattr(app_mod, 'n8n_execution_id', lambda response: None)
+    with app_mod.trace_context(job['trace_id'], job['trace_parent']):
+        outbox._handle(job)
+    start = conn.execute("SELECT start_time FROM trace_spans WHERE name = 'outbox.queue_wait'").fetchone()[0]
+    assert start == ready_at
+
+
+def test_identical_consulta_shares_the_job_in_progress(app_mod, client, auth, supabase):
+    di_id = '11111111-1111-1111-1111-111111111111'
+    supabase.tables['disenos_instruccionales'] = [{'id_di': di_id, 'id_usuario': 'user-1', 'proceso_actual': None}]
+    first = client.post(f'/api/dis/{di_id}/interact', json={'prompt': '¿Qué falta?'}, headers=auth())
+    second = client.post(f'/api/dis/{di_id}/interact', json={'prompt': '¿Qué falta?'}, headers=auth())
+    other = client.post(f'/api/dis/{di_id}/interact', json={'prompt': 'Otra pregunta'}, headers=auth())
+
+    assert (first.status_code, second.status_code, other.status_code) == (202, 202, 409)
+    assert second.get_json()['job']['proceso'] == 'consulta'
+    assert app_mod.state_db().execute('SELECT COUNT(*) FROM outbox').fetchone()[0] == 1
+
+
+def test_lane_wait_is_a_merged_histogram(app_mod, client, supabase, outbox):
+    def claimed(lane):
+        return app_mod._outbox.lane_stats().get(lane, {}).get('claimed', 0)
+
+    lane = app_mod.OUTBOX_LANES.get('validar-di', app_mod.OUTBOX_DEFAULT_LANE)
+    before = claimed(lane)
+    outbox.enqueue('validar-di', {'di_id': 'di-0'}, di_id='di-0', proceso='evaluacion')
+    outbox._claim()
+
+    assert claimed(lane) == before + 1
+    assert app_mod._outbox.lane_stats()[lane]['wait_p50'] == app_mod.HISTOGRAM_BUCKETS[0]
+    body = client.get('/metrics').get_data(as_text=True)
+    assert f'outbox_lane_wait_seconds_count{{lane="{lane}"}} {before + 1}' in body
@@ -0,0 +1,36 @@
+import base64
+import json
+import uuid
+
+import pytest
+
+
+def raw_cursor(created_at, row_id):
+    return base64.urlsafe_b64encode(json.dumps([created_at, row_id]).encode()).decode().rstrip('=')
+
+
+@pytest.fixture
+def dis(supabase):
+    supabase.tables['disenos_instruccionales'] = [
+        {'id_di': str(uuid.UUID(int=i)), 'id_usuario': 'user-1', 'nombre_archivo': f'{i}.docx',
+         'created_at': '2026-01-%02dT00:00:00+00:00' % i} for i in range(1, 6)]
+    return supabase.tables['disenos_instruccionales']
+
+
+def test_keyset_pages_follow_cursor(client, auth, dis):
+    first = client.get('/api/dis?limit=3', headers=auth()).get_json()
+    second = client.get(f"/api/dis?limit=3&cursor={first['next_cursor']}", headers=auth()).get_json()
+    names = [row['nombre_archivo'] for row in first['items'] + second['items']]
+    assert names == ['5.docx', '4.docx', '3.docx', '2.docx', '1.docx']
+    assert second['next_cursor'] is None
+
+
+@pytest.mark.parametrize('created_at, row_id', [
+    ('2026-01-03T00:00:00+00:00",id_usuario.neq."x', str(uuid.UUID(int=3))),
+    ('2026-01-03T00:00:00+00:00', '1),id_usuario.neq.(x'),
+    (20260103, str(uuid.UUID(int=3))),
+])
+def test_forged_cursor_is_rejected(client, auth, dis, created_at, row_id):
+    response = client.get(f'/api/dis?cursor={raw_cursor(created_at, row_id)}', headers=auth())
+    assert response.status_code == 400
+    assert response.get_json() == {'message': 'Cursor inválido.'}
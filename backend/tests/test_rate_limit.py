@@ -0,0 +1,36 @@
+import pytest
+
+DI_ID = '11111111-1111-1111-1111-111111111111'
+
+
+@pytest.fixture
+def one_token(app_mod, monkeypatch):
+    for route_class in ('batch', 'interactive'):
+        monkeypatch.setitem(app_mod.RATE_LIMITS, route_class, (1.0, 1e-6))
+
+
+@pytest.fixture
+def di(app_mod, supabase):
+    supabase.tables['disenos_instruccionales'] = [
+        {'id_di': DI_ID, 'id_usuario': 'user-1', 'nombre_archivo': 'a.docx', 'estructura_mei': 'MEI-Antiguo', 'proceso_actual': None}]
+    return supabase.tables['disenos_instruccionales'][0]
+
+
+def test_busy_di_does_not_spend_budget(app_mod, client, auth, di, one_token):
+    row = di
+    row['proceso_actual'] = app_mod.proceso_estado('consulta', 'processing')
+    for _ in range(2):
+        assert client.post(f'/api/dis/{DI_ID}/validate', headers=auth()).status_code == 409
+    row['proceso_actual'] = None
+    assert client.post(f'/api/dis/{DI_ID}/validate', headers=auth()).status_code == 202
+    row['proceso_actual'] = None
+    assert client.post(f'/api/dis/{DI_ID}/validate', headers=auth()).status_code == 429
+
+
+def test_unknown_mei_does_not_spend_budget(client, auth, di, one_token):
+    row = di
+    row['estructura_mei'] = 'MEI-Desconocido'
+    assert client.post(f'/api/dis/{DI_ID}/analyze-alignment', headers=auth()).status_code == 400
+    row['estructura_mei'] = 'MEI-Antiguo'
+    assert client.post(f'/api/dis/{DI_ID}/validate', headers=auth()).status_code == 202
+
@@ -0,0 +1,18 @@
+from datetime import datetime, timedelta, timezone
+
+
+def test_untimed_processing_rows_fail_without_retry(app_mod, supabase):
+    overdue = (datetime.now(timezone.utc) - timedelta(hours=1)).isoformat()
+    supabase.tables['disenos_instruccionales'] = [
+        {'id_di': 'legacy', 'estructura_mei': 'MEI-Antiguo', 'proceso_actual': {'nombre': 'evaluacion', 'estado': 'processing'}},
+        {'id_di': 'stuck', 'estructura_mei': 'MEI-Antiguo',
+         'proceso_actual': {'nombre': 'evaluacion', 'estado': 'processing', 'timestamp': overdue}},
+    ]
+    app_mod._reaper.scan()
+
+    legacy, stuck = supabase.tables['disenos_instruccionales']
+    assert legacy['proceso_actual']['estado'] == 'error'
+    assert app_mod._outbox.last_job('legacy', 'evaluacion') is None
+    assert stuck['proceso_actual']['estado'] == 'processing'
+    assert stuck['proceso_actual']['reintentos'] == 1
+    assert app_mod._outbox.last_job('stuck', 'evaluacion')['webhook'] == 'validar-di'
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+FILE_SIZE = 20 * 1024 * 1024  # client_max_body_size de nginx
+CHUNK_SIZE = 1024 * 1024  # el servidor de prueba no exige los 6 MB de Supabase
+PARALLEL_UPLOADS = 6
+
+
+class TusHandler(BaseHTTPRequestHandler):
+    """Servidor TUS mínimo: guarda sólo el digest de lo recibido."""
+    protocol_version = 'HTTP/1.1'
+    uploads = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        with self.lock:
+            upload_id = str(len(self.uploads))
+            self.uploads[upload_id] = {'length': int(self.headers['Upload-Length']), 'offset': 0, 'digest': hashlib.sha256()}
+        self._reply(201, {'Location': f'/storage/v1/upload/resumable/{upload_id}'})
+
+    def do_PATCH(self):
+        upload = self.uploads[self.path.rsplit('/', 1)[1]]
+        remaining = int(self.headers['Content-Length'])
+        assert int(self.headers['Upload-Offset']) == upload['offset']
+        while remaining:
+            data = self.rfile.read(min(remaining, 1024 * 1024))
+            upload['digest'].update(data)
+            remaining -= len(data)
+        upload['offset'] += int(self.headers['Content-Length'])
+        self._reply(204, {'Upload-Offset': str(upload['offset'])})
+
+    def do_HEAD(self):
+        self._reply(200, {'Upload-Offset': str(self.uploads[self.path.rsplit('/', 1)[1]]['offset'])})
+
+
+@pytest.fixture
+def tus_server(monkeypatch):
+    TusHandler.uploads = {}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('SUPABASE_URL', f'http://127.0.0.1:{server.server_address[1]}')
+    yield TusHandler
+    server.shutdown()
+
+
+def current_rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError('VmRSS no disponible')
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='requiere /proc')
+def test_parallel_large_uploads_keep_rss_flat(app_mod, client, auth, tus_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_mod, 'STORAGE_CHUNK_SIZE', CHUNK_SIZE)
+    digests = {}
+    for i in range(PARALLEL_UPLOADS):
+        path = tmp_path / f'di-{i}.docx'
+        digest = hashlib.sha256()
+        with open(path, 'wb') as f:
+            for _ in range(FILE_SIZE // (1024 * 1024)):
+                block = os.urandom(1024 * 1024)
+                digest.update(block)
+                f.write(block)
+        digests[path.name] = digest.hexdigest()
+
+    baseline, peak, done = current_rss(), [0], threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], current_rss())
+            time.sleep(0.005)
+
+    def upload(path, results):
+        with open(path, 'rb') as f:
+            response = client.post('/api/dis', headers=auth(), content_type='multipart/form-data',
+                                   data={'file': (f, path.name), 'estructuraMEI': 'MEI-Antiguo'})
+        results[path.name] = response.status_code
+
+    results = {}
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    threads = [threading.Thread(target=upload, args=(tmp_path / name, results)) for name in digests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    sampler.join()
+
+    assert results == {name: 201 for name in digests}
+    received = {upload['digest'].hexdigest() for upload in tus_server.uploads.values()}
+    assert received == set(digests.values())
+    # Leyendo los archivos completos el pico crecería con PARALLEL_UPLOADS *
+    # FILE_SIZE (120 MB); por bloques depende del tamaño de bloque, no del archivo.
+    growth = peak[0] - baseline
+    assert growth < PARALLEL_UPLOADS * FILE_SIZE / 4, \
+        f'pico de RSS: +{growth / 2 ** 20:.1f} MB para {PARALLEL_UPLOADS} x {FILE_SIZE // 2 ** 20} MB'
@@ -37,7 +37,8 @@ async function fetchWithAuth(endpoint, options = {}) {
     throw new Error('No hay sesión de usuario activa.');
   }
 
-  const fetchOptions = { ...options, cache: 'no-store' };
+  // 'no-cache' revalida con el ETag del backend: un 304 reutiliza la copia local.
+  const fetchOptions = { ...options, cache: 'no-cache' };
   const headers = { 'Authorization': `Bearer ${session.access_token}`, ...fetchOptions.headers };
 
   if (!(fetchOptions.body instanceof FormData)) {
@@ -47,7 +48,15 @@ async function fetchWithAuth(endpoint, options = {}) {
   fetchOptions.headers = headers;
 
   console.log(`[apiService] Realizando fetch a: ${API_URL}/${endpoint}`);
-  const response = await fetch(`${API_URL}/${endpoint}`, fetchOptions);
+  let response;
+  try {
+    response = await fetch(`${API_URL}/${endpoint}`, fetchOptions);
+  } catch (networkError) {
+    // Con Idempotency-Key el reintento es seguro: el backend devuelve la respuesta original.
+    if (!headers['Idempotency-Key']) throw networkError;
+    console.warn(`[apiService] Reintentando ${endpoint} tras error de red.`);
+    response = await fetch(`${API_URL}/${endpoint}`, fetchOptions);
+  }
 
   if (!response.ok) {
     const errorData = await response.json().catch(() => ({ error: `Error en la API: ${response.statusText}` }));
@@ -67,6 +76,11 @@ async function fetchWithAuth(endpoint, options = {}) {
 }
 
 
+// Los disparos de procesos de IA llevan una clave única por acción del usuario.
+function triggerOptions(options = {}) {
+  return { ...options, headers: { 'Idempotency-Key': crypto.randomUUID(), ...options.headers } };
+}
+
 export function getDis() {
   return fetchWithAuth('dis');
 }
@@ -99,14 +113,18 @@ export function getDiValidation(diId) {
 }
 
 export function generateDiValidation(diId) {
-  return fetchWithAuth(`dis/${diId}/validate`, { method: 'POST' });
+  return fetchWithAuth(`dis/${diId}/validate`, triggerOptions({ method: 'POST' }));
 }
 
 export function interactWithDi(diId, prompt) {
-  return fetchWithAuth(`dis/${diId}/interact`, {
+  return fetchWithAuth(`dis/${diId}/interact`, triggerOptions({
     method: 'POST',
     body: JSON.stringify({ prompt: prompt }),
-  });
+  }));
+}
+
+export function cancelDiProcess(diId) {
+  return fetchWithAuth(`dis/${diId}/cancel`, triggerOptions({ method: 'POST' }));
 }
 
 export function syncDomainGlossary() {
@@ -118,7 +136,7 @@ export function syncVocabularyGlossary() {
 }
 
 export function analyzeAlignment(diId) {
-  return fetchWithAuth(`dis/${diId}/analyze-alignment`, { method: 'POST' });
+  return fetchWithAuth(`dis/${diId}/analyze-alignment`, triggerOptions({ method: 'POST' }));
 }
 
 export function generateIndicators(payload) {
@@ -136,8 +154,16 @@ export function revisarIndicadores(payload) {
   });
 }
 
-export function getGenerations() {
-    return fetchWithAuth('generations');
+// Página de resúmenes (id, nombre, estructura_mei, es_revision); `cursor` es el
+// `next_cursor` de la página anterior.
+export function getGenerations(cursor = null, limit = 50) {
+    const params = new URLSearchParams({ limit });
+    if (cursor) params.set('cursor', cursor);
+    return fetchWithAuth(`generations?${params}`);
+}
+
+export function getGeneration(generationId) {
+    return fetchWithAuth(`generations/${generationId}`);
 }
 
 export function deleteGeneration(generationId) {
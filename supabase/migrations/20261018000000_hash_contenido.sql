@@ -0,0 +1,4 @@
+-- Deduplicación de DIs por contenido: SHA-256 del archivo subido.
+ALTER TABLE disenos_instruccionales ADD COLUMN IF NOT EXISTS hash_contenido text;
+CREATE INDEX IF NOT EXISTS disenos_instruccionales_usuario_hash_idx
+    ON disenos_instruccionales (id_usuario, hash_contenido);
@@ -0,0 +1,18 @@
+-- ETag baratos: cada fila guarda la hora de su última escritura, incluidas
+-- las que n8n hace directo en Supabase.
+ALTER TABLE disenos_instruccionales ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT clock_timestamp();
+ALTER TABLE generaciones_ia ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT clock_timestamp();
+
+CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.updated_at := clock_timestamp();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS disenos_instruccionales_updated_at ON disenos_instruccionales;
+CREATE TRIGGER disenos_instruccionales_updated_at BEFORE UPDATE ON disenos_instruccionales
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();
+DROP TRIGGER IF EXISTS generaciones_ia_updated_at ON generaciones_ia;
+CREATE TRIGGER generaciones_ia_updated_at BEFORE UPDATE ON generaciones_ia
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at();